@@ -3,7 +3,12 @@ Blackjack card game. Built this as a milestone project in my Python training cou
 '''
 
 import random
-from os import system, name
+import argparse
+import time
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from os import system, name, cpu_count
 
 def clear():
   
@@ -20,26 +25,146 @@ suits = ["Hearts","Diamonds","Clubs","Spades"]
 ranks = ["Two","Three","Four","Five","Six","Seven","Eight","Nine","Ten","Jack","Queen","King","Ace"]
 values = {"Two":2,"Three":3,"Four":4,"Five":5,"Six":6,"Seven":7,"Eight":8,"Nine":9,"Ten":10,"Jack":10,"Queen":10,"King":10,"Ace":11}
 
+#Shoe settings: number of decks, and how far into the shoe the cut card is placed before it is shuffled again
+shoe_decks = 6
+shoe_penetration = 0.75
+
+#Cards are encoded as small ints, suit index * 13 + rank index, so that a deck is a plain byte array. Values and ranks
+#come from these lookup tables and Card objects are only used to display a card
+card_values = bytes(values[rank] for suit in suits for rank in ranks)
+card_ranks = bytes(ranks.index(rank) for suit in suits for rank in ranks)
+full_deck = bytes(range(len(suits) * len(ranks)))
+
+#Scoring and payout rules, shared by the interactive game and the headless Engine. Hands are lists of card codes
+def hand_transition(state,value):
+	#A hand's score state is its best total and whether an ace in it is counted as 11, packed as total * 2 + soft
+	total = state >> 1
+	soft = state & 1
+	if value == 11 and total + 11 <= 21:
+		total += 11
+		soft = 1
+	elif value == 11:
+		total += 1
+	else:
+		total += value
+	
+	#Count the soft ace as 1 instead of going bust
+	if total > 21 and soft:
+		total -= 10
+		soft = 0
+	return total << 1 | soft
+
+#The score state after dealing a card, indexed by state * 52 + card code. Totals never pass 31, so 64 states cover it
+hand_transitions = bytes(hand_transition(state,card_values[card]) for state in range(64) for card in range(len(full_deck)))
+
+class HandState:
+	#Score of a hand, updated with one table lookup per card
+	def __init__(self):
+		self.cards = []
+		self.state = 0
+		self.total = 0
+		self.bust = False
+		self.blackjack = False
+		
+	def add_card(self,card):
+		self.cards.append(card)
+		self.state = hand_transitions[self.state * 52 + card]
+		self.total = self.state >> 1
+		self.bust = self.total > 21
+		self.blackjack = self.total == 21 and len(self.cards) == 2
+		
+	@property
+	def soft(self):
+		return bool(self.state & 1)
+		
+	def rescore(self):
+		#Score the hand again from its first card, after a card has been taken out of it
+		cards = self.cards
+		HandState.__init__(self)
+		for card in cards:
+			self.add_card(card)
+			
+	def __str__(self):
+		if self.bust:
+			return "Bust!"
+		elif self.blackjack:
+			return "Blackjack!"
+		return str(self.total)
+
+def check_score(cards):
+	hand = HandState()
+	for card in cards:
+		hand.add_card(card)
+	return hand
+
+def payout_amount(player,dealer,bet):
+	#Chips returned to a hand at the end of the round, including the bet. A lost hand returns nothing
+	if player.bust:
+		return 0
+	elif dealer.blackjack:
+		if player.blackjack:
+			return bet
+		return 0
+	elif player.blackjack:
+		return bet * 2.5
+	elif dealer.bust:
+		return bet * 2
+	elif player.total == dealer.total:
+		return bet
+	elif player.total > dealer.total:
+		return bet * 2
+	return 0
+
 class Card:
 	def __init__(self,suit,rank):
 		self.suit = suit
 		self.rank = rank
 		self.value = values[rank]
+		self.code = suits.index(suit) * len(ranks) + ranks.index(rank)
 		
 	def __str__(self):
 		return f"{self.rank} of {self.suit}"
 		
+#One shared Card per card code, for display
+display_cards = [Card(suit,rank) for suit in suits for rank in ranks]
+
 class Deck:
-	def __init__(self):
-		self.all_cards = []
-		for suit in suits:
-			for rank in ranks:
-				self.all_cards.append(Card(suit,rank))
+	def __init__(self,decks = 1,seed = None):
+		self.full_deck = full_deck * decks
+		self.all_cards = bytearray(self.full_deck)
+		self.random = random.Random(seed)
 				
 	def shuffle(self):
-		random.shuffle(self.all_cards)
+		#Gather every card back in and shuffle them in place. A Fisher-Yates shuffle drawing floats is about twice as
+		#fast as random.shuffle's exact integer draws, and the bias is far too small to show up in a shoe
+		cards = self.all_cards
+		cards[:] = self.full_deck
+		draw = self.random.random
+		for i in range(len(cards) - 1,0,-1):
+			j = int(draw() * (i + 1))
+			cards[i], cards[j] = cards[j], cards[i]
+		
+	def deal(self):
+		return self.all_cards.pop()
 		
 	def deal_card(self):
+		return display_cards[self.deal()]
+		
+class Shoe(Deck):
+	#Several decks shuffled together and kept from round to round. Once the cut card comes out the shoe is shuffled
+	#before the next round. A penetration of 0 shuffles before every round
+	def __init__(self,decks = shoe_decks,penetration = shoe_penetration,seed = None):
+		super().__init__(decks,seed)
+		self.cut_card = round(len(self.full_deck) * (1 - penetration))
+		self.shuffle()
+		
+	def needs_shuffle(self):
+		return len(self.all_cards) <= self.cut_card
+		
+	def deal(self):
+		#A shoe that runs out in the middle of a round is shuffled on the spot
+		if not self.all_cards:
+			self.shuffle()
 		return self.all_cards.pop()
 		
 class Table:
@@ -96,11 +221,11 @@ class Table:
 		for player in current_players:
 			self.bets[player.name] = ""
 			self.cards[player.name] = []
-			self.scores[player.name] = ""
+			self.scores[player.name] = HandState()
 			player.split = False
 		
 		self.cards["Dealer"] = []
-		self.scores["Dealer"] = ""
+		self.scores["Dealer"] = HandState()
 		
 class Player:
 	def __init__(self,name,chips):
@@ -136,9 +261,9 @@ class Player:
 			cards = table.cards[self.name]
 			actions = ["Stand","Hit"]
 		
-			if table.scores[self.name] == "Bust!":
+			if table.scores[self.name].bust:
 				break
-			elif table.scores[self.name] == "Blackjack!":
+			elif table.scores[self.name].blackjack:
 				break
 			elif self.split == True:
 				dealer.deal_card(self)
@@ -152,7 +277,7 @@ class Player:
 				if self.chips - table.bets[self.name] >= 0:
 					print("Split")
 					actions.append("Split")
-			elif table.scores[self.name] in [9,10,11] and len(cards) == 2 and self.split == False:
+			elif table.scores[self.name].total in [9,10,11] and len(cards) == 2 and self.split == False:
 				if self.chips - table.bets[self.name] >= 0:
 					print("Double Down")
 					actions.append("Double Down")
@@ -179,6 +304,10 @@ class Player:
 					self.split = True
 					current_players[split_index].split = True
 					table.scores[f"{self.name}-split"] = dealer.check_score((table.cards[f"{self.name}-split"]))
+					
+					#Take the split card out of this hand's score as well
+					table.scores[self.name].cards.pop(1)
+					table.scores[self.name].rescore()
 			elif action == "Double Down":
 				if action not in actions:
 					continue
@@ -201,7 +330,7 @@ class Dealer:
 	def __init__(self):
 		self.name = "Dealer"
 		self.hidden_card = True
-		self.deck = Deck()
+		self.deck = Shoe()
 		
 	def shuffle(self):
 		self.deck.shuffle()
@@ -214,58 +343,28 @@ class Dealer:
 		self.update_score(player)
 		
 	def update_score(self,player):
+		#Add the visible cards the score has not counted yet. A hidden card is added once it is turned over
+		cards = table.cards[player.name]
+		visible = len(cards)
 		if player.hidden_card == True:
 			if player.name == "Dealer":
-				table.scores["Dealer"] = self.check_score([table.cards["Dealer"][0]])
+				visible = 1
 			else:
-				card = table.cards[player.name]
-				table.scores[player.name] = self.check_score([card[0],card[1]])
-		else:
-			table.scores[player.name] = self.check_score(table.cards[player.name])
+				visible = 2
+		
+		hand = table.scores[player.name]
+		for card in cards[len(hand.cards):visible]:
+			hand.add_card(card.code)
 				
 	def check_score(self,cards):
-		total = 0
-		ace = False
-	
-		for card in cards:
-			if card.rank == "Ace":
-				ace = True
-			total += card.value
-		if total > 21:
-			if ace:
-				total -= 10
-				if total <= 21:
-					return total
-				else:
-					return "Bust!"
-			else:
-				return "Bust!"
-		elif total == 21:
-			if len(cards) == 2:
-				return "Blackjack!"
-			else:
-				return 21
-		else:
-			return total
+		return check_score([card.code for card in cards])
 			
 	def payout(self,player):
 		dealer_score = table.scores["Dealer"]
 		player_score = table.scores[player.name]
 		bet = table.bets[player.name]
 		
-		if player_score == "Bust!":
-			return
-		elif dealer_score == "Blackjack!":
-			if player_score == "Blackjack!":
-				player.chips += bet
-		elif player_score == "Blackjack!":
-			player.chips += bet * 2.5
-		elif dealer_score == "Bust!":
-			player.chips += bet * 2
-		elif player_score == dealer_score:
-			player.chips += bet
-		elif player_score > dealer_score:
-			player.chips += bet * 2
+		player.chips += payout_amount(player_score,dealer_score,bet)
 		
 		if "split" in player.name:
 			player_index = current_players.index(player) - 1
@@ -302,8 +401,10 @@ class Game:
 					current_players.append(Player(player_name,self.player_chips))
 					table.cards[player_name] = []
 					table.bets[player_name] = 0
+					table.scores[player_name] = HandState()
 					taken_names.append(player_name)
 		table.cards["Dealer"] = []
+		table.scores["Dealer"] = HandState()
 		
 	def remove_player(self,player):
 		current_players.remove(player)
@@ -324,14 +425,16 @@ class Game:
 			#Setup the players
 			self.player_setup()
 			
-			while True:
+			#Setup Dealer. The shoe is kept from round to round
+			global dealer
+			dealer = Dealer()
 			
-				#Setup Dealer
-				global dealer
-				dealer = Dealer()
+			while True:
 			
-				#Shuffle Deck
-				dealer.shuffle()
+				#Shuffle the shoe once the cut card has come out
+				dealer.hidden_card = True
+				if dealer.deck.needs_shuffle():
+					dealer.shuffle()
 			
 				#Place bets
 				for player in current_players:
@@ -360,9 +463,9 @@ class Game:
 				dealer.update_score(dealer)
 				
 				while True:
-					if table.scores["Dealer"] in ["Bust!","Blackjack!"]:
+					if table.scores["Dealer"].bust or table.scores["Dealer"].blackjack:
 						break
-					elif table.scores["Dealer"] >= 17:
+					elif table.scores["Dealer"].total >= 17:
 						break
 						
 					dealer.deal_card(dealer)
@@ -412,6 +515,256 @@ class Game:
 			print("Thanks for playing!")
 			break
 			
+#Headless simulation. Plays the same rules as the game above, with a policy making each choice a player is prompted for
+#and all of the state kept on the Engine, so that rounds can be played without a terminal. Hands hold card codes
+class Hand(HandState):
+	def __init__(self,bet,split = False):
+		super().__init__()
+		self.bet = bet
+		self.split = split
+		self.doubled = False
+		
+class Seat:
+	#A simulated player. With chips = None the seat has an unlimited bankroll and only its net result is tracked
+	def __init__(self,name,policy,bet = 1,chips = None):
+		self.name = name
+		self.policy = policy
+		self.bet = bet
+		self.chips = chips
+		self.net = 0
+		self.hands = []
+		
+	def can_afford(self,amount):
+		return self.chips is None or self.chips >= amount
+		
+	def take(self,amount):
+		self.net -= amount
+		if self.chips is not None:
+			self.chips -= amount
+			
+	def give(self,amount):
+		self.net += amount
+		if self.chips is not None:
+			self.chips += amount
+			
+class Stats:
+	fields = ("rounds","shuffles","hands","wins","losses","pushes","blackjacks","busts","splits","doubles","wagered","returned")
+	
+	def __init__(self):
+		for field in self.fields:
+			setattr(self,field,0)
+			
+	def record(self,hand,amount):
+		self.hands += 1
+		self.wagered += hand.bet
+		self.returned += amount
+		if hand.blackjack:
+			self.blackjacks += 1
+		elif hand.bust:
+			self.busts += 1
+			
+		if amount > hand.bet:
+			self.wins += 1
+		elif amount == hand.bet:
+			self.pushes += 1
+		else:
+			self.losses += 1
+			
+	def merge(self,counts):
+		#Add the counts from another run, as returned by as_dict
+		for field in self.fields:
+			setattr(self,field,getattr(self,field) + counts[field])
+			
+	def house_edge(self):
+		#Share of the wagered chips kept by the house
+		if not self.wagered:
+			return 0
+		return (self.wagered - self.returned) / self.wagered
+		
+	def as_dict(self):
+		return {field: getattr(self,field) for field in self.fields}
+		
+class Engine:
+	def __init__(self,seats,decks = shoe_decks,penetration = shoe_penetration,seed = None):
+		self.seats = seats
+		self.stats = Stats()
+		self.shoe = Shoe(decks,penetration,seed)
+		
+	def run(self,rounds):
+		for _ in range(rounds):
+			self.play_round()
+		return self.stats
+		
+	def play_round(self):
+		deck = self.shoe
+		if deck.needs_shuffle():
+			deck.shuffle()
+			self.stats.shuffles += 1
+		self.stats.rounds += 1
+		
+		#Place bets. Seats that cannot cover their bet sit the round out
+		playing = []
+		for seat in self.seats:
+			if seat.can_afford(seat.bet):
+				seat.take(seat.bet)
+				seat.hands = [Hand(seat.bet)]
+				playing.append(seat)
+			else:
+				seat.hands = []
+				
+		#Deal cards
+		dealer = Hand(0)
+		for _ in range(2):
+			for seat in playing:
+				seat.hands[0].add_card(deck.deal())
+			dealer.add_card(deck.deal())
+			
+		#Player actions
+		for seat in playing:
+			self.play_seat(seat,card_values[dealer.cards[0]],deck)
+			
+		#Dealer draws cards until greater than or equal to 17
+		while dealer.total < 17:
+			dealer.add_card(deck.deal())
+			
+		#Award winners
+		for seat in playing:
+			for hand in seat.hands:
+				amount = payout_amount(hand,dealer,hand.bet)
+				seat.give(amount)
+				self.stats.record(hand,amount)
+				
+	def play_seat(self,seat,upcard,deck):
+		#The choices Player.player_actions offers. A pair can be split once and each split hand takes one card,
+		#9 to 11 on the first two cards can be doubled down for one card
+		index = 0
+		while index < len(seat.hands):
+			hand = seat.hands[index]
+			while True:
+				if hand.bust or hand.blackjack:
+					break
+				elif hand.split:
+					hand.add_card(deck.deal())
+					break
+					
+				cards = hand.cards
+				actions = ["Stand","Hit"]
+				if len(cards) == 2 and card_ranks[cards[0]] == card_ranks[cards[1]]:
+					if seat.can_afford(hand.bet):
+						actions.append("Split")
+				elif hand.total in [9,10,11] and len(cards) == 2:
+					if seat.can_afford(hand.bet):
+						actions.append("Double Down")
+						
+				action = seat.policy(hand,upcard,actions)
+				if action == "Stand":
+					break
+				elif action == "Hit":
+					hand.add_card(deck.deal())
+				elif action == "Split" and action in actions:
+					seat.take(hand.bet)
+					split_hand = Hand(hand.bet,True)
+					split_hand.add_card(cards.pop())
+					hand.split = True
+					hand.rescore()
+					seat.hands.insert(index + 1,split_hand)
+					self.stats.splits += 1
+				elif action == "Double Down" and action in actions:
+					seat.take(hand.bet)
+					hand.bet += hand.bet
+					hand.doubled = True
+					hand.add_card(deck.deal())
+					self.stats.doubles += 1
+					break
+				else:
+					raise ValueError(f"{seat.name}'s policy chose {action}, expected one of {actions}")
+			index += 1
+			
+#Player policies. Each one is given the hand, the value of the dealer's face up card and the allowed actions, and
+#returns an action
+def dealer_policy(hand,upcard,actions):
+	#Play like the dealer, hitting until 17 or more
+	if hand.total < 17:
+		return "Hit"
+	return "Stand"
+	
+def basic_policy(hand,upcard,actions):
+	#Simplified basic strategy on the hand total
+	score = hand.total
+	if "Split" in actions and card_values[hand.cards[0]] in (11,8):
+		return "Split"
+	if "Double Down" in actions and score in (10,11) and upcard < score:
+		return "Double Down"
+	if hand.soft:
+		if score <= 17 or (score == 18 and upcard >= 9):
+			return "Hit"
+		return "Stand"
+	if score <= 11:
+		return "Hit"
+	if score == 12 and upcard in (2,3):
+		return "Hit"
+	if score <= 16 and upcard >= 7:
+		return "Hit"
+	return "Stand"
+	
+policies = {"basic": basic_policy, "dealer": dealer_policy}
+
+def simulate(rounds,policy = "basic",players = 1,decks = shoe_decks,penetration = shoe_penetration,seed = None):
+	seats = [Seat(f"Player {num}",policies[policy]) for num in range(1,players + 1)]
+	return Engine(seats,decks,penetration,seed).run(rounds)
+	
+def shard_seed(seed,shard):
+	#Independent seed for each shard of a parallel run, derived from the run's seed
+	digest = hashlib.sha256(f"{seed}:{shard}".encode()).digest()
+	return int.from_bytes(digest[:8],"big")
+	
+def simulate_shard(rounds,policy,players,decks,penetration,seed):
+	return simulate(rounds,policy,players,decks,penetration,seed).as_dict()
+	
+def simulate_parallel(rounds,policy = "basic",players = 1,decks = shoe_decks,penetration = shoe_penetration,seed = 0,workers = None,shard_rounds = 50000):
+	#Split the rounds into fixed size shards, each with its own shoe seeded from the run's seed, and play them on a
+	#process pool. The shards do not depend on the number of workers, so a seed gives the same results on any machine
+	shards = [shard_rounds] * (rounds // shard_rounds)
+	if rounds % shard_rounds:
+		shards.append(rounds % shard_rounds)
+	seeds = [shard_seed(seed,shard) for shard in range(len(shards))]
+	args = (shards,itertools.repeat(policy),itertools.repeat(players),itertools.repeat(decks),itertools.repeat(penetration),seeds)
+	
+	stats = Stats()
+	if workers == 1:
+		for counts in map(simulate_shard,*args):
+			stats.merge(counts)
+	else:
+		with ProcessPoolExecutor(max_workers = workers) as executor:
+			for counts in executor.map(simulate_shard,*args):
+				stats.merge(counts)
+	return stats
+	
 if __name__ == "__main__":
-	blackjack = Game()
-	blackjack.StartGame()
+	parser = argparse.ArgumentParser(description = "Blackjack. Plays the interactive game unless --simulate is given")
+	parser.add_argument("--simulate",type = int,metavar = "ROUNDS",help = "play this many rounds headless and print the results")
+	parser.add_argument("--policy",choices = sorted(policies),default = "basic",help = "player policy for --simulate")
+	parser.add_argument("--players",type = int,default = 1,help = "number of simulated players")
+	parser.add_argument("--decks",type = int,default = shoe_decks,help = "decks in the shoe")
+	parser.add_argument("--penetration",type = float,default = shoe_penetration,help = "share of the shoe dealt before it is shuffled")
+	parser.add_argument("--seed",type = int,help = "seed for the shuffles, making the results reproducible")
+	parser.add_argument("--workers",type = int,default = cpu_count(),help = "processes playing the rounds")
+	args = parser.parse_args()
+	
+	if args.simulate:
+		#Pick a seed when none is given and print it, so that any run can be repeated
+		seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+		start = time.perf_counter()
+		stats = simulate_parallel(args.simulate,args.policy,args.players,args.decks,args.penetration,seed,args.workers)
+		elapsed = time.perf_counter() - start
+		print(f"{'seed':<{15}}: {seed}")
+		for field, value in stats.as_dict().items():
+			print(f"{field:<{15}}: {value}")
+		print(f"{'net chips':<{15}}: {stats.returned - stats.wagered}")
+		print(f"{'split rate':<{15}}: {stats.splits / max(stats.hands,1):.2%}")
+		print(f"{'double rate':<{15}}: {stats.doubles / max(stats.hands,1):.2%}")
+		print(f"{'house edge':<{15}}: {stats.house_edge():.2%}")
+		print(f"{'rounds/second':<{15}}: {stats.rounds / elapsed:.0f}")
+	else:
+		blackjack = Game()
+		blackjack.StartGame()
@@ -0,0 +1,497 @@
+'''
+Offline benchmark for club_membership_reports.
+
+Runs the full pipeline (Wordpress exports, spreadsheet creation and Google Drive upload) against local
+stand-ins: a fake Paid Memberships Pro server that serves synthetic membership and orders CSV exports,
+and an in-memory fake of the pydrive client used by GoogleDrive. Nothing touches the real Wordpress site
+or Google Drive, so throughput regressions can be caught on any machine.
+
+Usage:
+    python benchmark.py                                   # default scenarios
+    python benchmark.py --scenario 100000:500 --scenario 1000000:5000
+    python benchmark.py --drive-latency 0.05 --workers 8  # simulate Drive round trips
+    python benchmark.py --save baseline.json              # record results
+    python benchmark.py --baseline baseline.json          # fail if a stage got slower than the baseline allows
+    python benchmark.py --startup --save startup.json     # import and --help time, using python -X importtime
+'''
+
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import yaml
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import club_membership_reports as reports
+
+MEMBERSHIP_COLUMNS = [
+    'id', 'username', 'firstname', 'lastname', 'email', 'membership', 'phone',
+    'billing firstname', 'billing lastname', 'address1', 'city', 'state', 'zipcode',
+    'initial payment', 'fee', 'term', 'joined', 'expires', 'home_club',
+]
+ORDERS_COLUMNS = [
+    'id', 'code', 'user_id', 'user_login', 'first_name', 'last_name', 'email',
+    'membership_level', 'subtotal', 'tax', 'total', 'status', 'gateway', 'timestamp',
+]
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+def synthetic_exports(members, clubs, seed=0):
+    # Build membership and orders CSV exports shaped like the PMPro ones. Each member has one order
+    rng = random.Random(seed)
+    club_names = [f'Club {number}' for number in range(clubs)]
+    levels = ['Individual', 'Family', 'Student', 'Lifetime']
+    states = ['CA', 'NY', 'TX', 'WA', 'FL']
+
+    membership = [','.join(MEMBERSHIP_COLUMNS)]
+    orders = [','.join(ORDERS_COLUMNS)]
+    for id in range(1, members + 1):
+        level = rng.choice(levels)
+        fee = rng.choice((25, 40, 60))
+        joined = f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+        # A few percent of members have no club, like real data
+        club = 'Unknown' if rng.random() < 0.03 else rng.choice(club_names)
+        membership.append(
+            f'{id},member{id},First{id},Last{id},member{id}@example.com,{level},555-{id % 10000:04d},'
+            f'First{id},Last{id},{id} Main St,Springfield,{rng.choice(states)},{rng.randint(10000, 99999)},'
+            f'{fee},{fee},Year,{joined} 10:00:00,{joined[:3]}5{joined[4:]} 10:00:00,{club}'
+        )
+        orders.append(
+            f'{id},ORD{id:08d},{id},member{id},First{id},Last{id},member{id}@example.com,'
+            f'{level},{fee},0,{fee},success,stripe,{joined} 10:00:00'
+        )
+
+    return ('\n'.join(membership) + '\n').encode('utf8'), ('\n'.join(orders) + '\n').encode('utf8')
+
+class FakeWordpress():
+    # Local HTTP server standing in for wp-login.php and the PMPro CSV export endpoints
+    chunk_size = 64 * 1024
+
+    def __init__(self, membership_csv, orders_csv, latency=0):
+        exports = {'/memberslist_csv': membership_csv, '/orders_csv': orders_csv}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path == '/wp-login.php':
+                    self.send_response(200)
+                    self.send_header('Set-Cookie', 'wordpress_logged_in=benchmark; Path=/')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = exports.get(urllib.parse.urlparse(self.path).path)
+                if body is None:
+                    self.send_error(404)
+                    return
+
+                # Export generation time on the server
+                time.sleep(latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                for start in range(0, len(body), FakeWordpress.chunk_size):
+                    self.wfile.write(body[start:start + FakeWordpress.chunk_size])
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeDriveFile(dict):
+    # Minimal stand-in for pydrive.files.GoogleDriveFile
+    def __init__(self, drive, metadata):
+        super().__init__(metadata)
+        self.drive = drive
+        self.content = None
+        self.uploaded = False
+        self.dirty = {'content': False}
+
+    def SetContentFile(self, filename):
+        self.content = open(filename, 'rb')
+
+    def Upload(self, param=None):
+        self.drive.api_call()
+        if 'id' not in self:
+            self['id'] = f'fake{next(self.drive.ids)}'
+        self.setdefault('labels', {'trashed': False})
+
+        size = 0
+        if self.content is not None:
+            size = len(self.content.read())
+            self.content.close()
+            self.content = None
+
+        self.drive.store(self, size)
+
+    def GetChanges(self):
+        return {key: value for key, value in self.items() if key != 'id'}
+
+    def UpdateMetadata(self, metadata):
+        self.update(metadata)
+
+class FakeUploadRequest():
+    # Stand-in for a googleapiclient resumable upload request, reading one chunk of the media per call
+    def __init__(self, drive, body, media_body, file_id=None):
+        self.drive = drive
+        self.metadata = dict(body, id=file_id) if file_id else dict(body)
+        self.media = media_body
+        self.progress = 0
+
+    def next_chunk(self, http=None):
+        self.drive.api_call()
+        chunk = self.media.getbytes(self.progress, self.media.chunksize())
+        self.progress += len(chunk)
+        if self.progress < self.media.size():
+            return self.progress, None
+
+        file = FakeDriveFile(self.drive, self.metadata)
+        if 'id' not in file:
+            file['id'] = f'fake{next(self.drive.ids)}'
+        file.setdefault('labels', {'trashed': False})
+        self.drive.store(file, self.progress)
+        return None, dict(file)
+
+class FakeRequest():
+    # Stand-in for a googleapiclient metadata request, run on its own or inside a FakeBatch
+    def __init__(self, action):
+        self.action = action
+
+    def execute(self, http=None):
+        return self.action()
+
+class FakeBatch():
+    # Stand-in for googleapiclient's BatchHttpRequest: one API call for all of its requests
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.drive.api_call()
+        for request_id, request in self.requests:
+            self.callback(request_id, request.action(), None)
+
+class FakeFiles():
+    def __init__(self, drive):
+        self.drive = drive
+
+    def insert(self, body=None, media_body=None, fields=None):
+        if media_body is None:
+            return FakeRequest(lambda: dict(self.drive.create(body or {})))
+        return FakeUploadRequest(self.drive, body or {}, media_body)
+
+    def update(self, fileId=None, body=None, media_body=None):
+        return FakeUploadRequest(self.drive, body or {}, media_body, fileId)
+
+    def list(self, q='', maxResults=None, pageToken=None):
+        return FakeRequest(lambda: self.drive.page(q, maxResults, pageToken))
+
+class FakeAuth():
+    # The parts of pydrive's GoogleAuth that GoogleDrive uses for resumable uploads and batch requests
+    def __init__(self, drive):
+        self.service = self
+        self.drive = drive
+
+    def files(self):
+        return FakeFiles(self.drive)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.drive, callback)
+
+    def Get_Http_Object(self):
+        return None
+
+class FakeDriveList(dict):
+    # Pages like pydrive's GoogleDriveFileList. With maxResults set, GetList returns one page and stores the next
+    # page token, which is None after the last page. Without it, GetList follows every page itself
+    def __init__(self, drive, param):
+        super().__init__(param)
+        self.drive = drive
+
+    def GetList(self):
+        if self.get('maxResults') is None:
+            self['maxResults'] = 1000
+            items = []
+            while self.get('pageToken', '') is not None:
+                items.extend(self.GetList())
+            del self['maxResults']
+            return items
+
+        if 'pageToken' in self and self['pageToken'] is None:
+            raise StopIteration
+        self.drive.api_call()
+        page = self.drive.page(self['q'], self['maxResults'], self.get('pageToken'))
+        self['pageToken'] = page.get('nextPageToken')
+        return [FakeDriveFile(self.drive, item) for item in page['items']]
+
+class FakeDrive():
+    # In-memory stand-in for pydrive.drive.GoogleDrive, with an optional delay per API call
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.files = {}
+        self.ids = itertools.count()
+        self.calls = 0
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+        self.auth = FakeAuth(self)
+
+    def store(self, file, size):
+        with self.lock:
+            self.uploaded_bytes += size
+            self.files[file['id']] = {key: value for key, value in file.items()}
+
+    def create(self, metadata):
+        file = FakeDriveFile(self, metadata)
+        file['id'] = f'fake{next(self.ids)}'
+        file.setdefault('labels', {'trashed': False})
+        self.store(file, 0)
+        return file
+
+    def query(self, query):
+        # Understands the queries GoogleDrive and DriveIndex send: parents, mimeType, title and trashed
+        parents = set(re.findall(r"'([^']+)' in parents", query))
+        title = re.search(r"title='([^']*)'", query)
+        with self.lock:
+            items = list(self.files.values())
+
+        results = []
+        for item in items:
+            if not parents & {parent['id'] for parent in item.get('parents', [])}:
+                continue
+            if f"mimeType='{FOLDER_MIME_TYPE}'" in query and item.get('mimeType') != FOLDER_MIME_TYPE:
+                continue
+            if f"mimeType!='{FOLDER_MIME_TYPE}'" in query and item.get('mimeType') == FOLDER_MIME_TYPE:
+                continue
+            if title and item['title'] != title.group(1):
+                continue
+            results.append(item)
+        return results
+
+    def page(self, query, max_results=None, page_token=None):
+        # One page of files.list results. Drive returns 100 results by default, and the page token here is the
+        # offset of the next page
+        items = self.query(query)
+        start = int(page_token or 0)
+        end = start + (max_results or 100)
+        page = {'items': [dict(item) for item in items[start:end]]}
+        if end < len(items):
+            page['nextPageToken'] = str(end)
+        return page
+
+    def api_call(self):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def CreateFile(self, metadata=None):
+        return FakeDriveFile(self, metadata or {})
+
+    def ListFile(self, param=None):
+        return FakeDriveList(self, param or {})
+
+def write_config(working_dir, url, args):
+    config = {
+        'wordpress': {
+            'header': {'user-agent': 'benchmark'},
+            'wp_login': f'{url}/wp-login.php',
+            'wp_admin': f'{url}/wp-admin/',
+            'username': 'benchmark',
+            'password': 'benchmark',
+            'membership_url': f'{url}/memberslist_csv',
+            'orders_url': f'{url}/orders_csv',
+        },
+        'google_drive': {
+            'club_folders_id': 'clubs',
+            'reports_folder_id': 'reports',
+            'upload_workers': args.workers,
+            'requests_per_second': 0,
+            'id_cache': True,
+            'resumable_threshold_mb': args.resumable_threshold_mb,
+            'chunk_size_mb': args.chunk_size_mb,
+            'batch_size': args.batch_size,
+        },
+        'reports': {
+            'workers': args.processes,
+            'autofit_sample_rows': args.autofit_sample_rows,
+            'in_memory': args.in_memory,
+            'memory_budget_mb': args.memory_budget_mb,
+        },
+    }
+    with open(f'{working_dir}/config.yaml', 'w') as file:
+        yaml.safe_dump(config, file)
+
+    return reports.Config(f'{working_dir}/config.yaml')
+
+def run_scenario(members, clubs, args):
+    membership_csv, orders_csv = synthetic_exports(members, clubs, args.seed)
+    server = FakeWordpress(membership_csv, orders_csv, args.wordpress_latency)
+    drive = FakeDrive(args.drive_latency)
+    result = {'members': members, 'clubs': clubs, 'csv_bytes': len(membership_csv) + len(orders_csv)}
+
+    try:
+        with tempfile.TemporaryDirectory() as working_dir:
+            reports.logger = reports.create_logger(working_dir)
+            reports.metrics = reports.Metrics()
+            config = write_config(working_dir, server.url, args)
+
+            start = time.perf_counter()
+            wordpress = reports.Wordpress(config)
+            result['wordpress_seconds'] = time.perf_counter() - start
+
+            workbooks = reports.WorkbookStore(config)
+            checkpoint = reports.Checkpoint(config)
+            start = time.perf_counter()
+            spreadsheets, build_failed = reports.create_spreadsheets(config, wordpress, workbooks, checkpoint)
+            result['create_spreadsheets_seconds'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            gdrive = reports.GoogleDrive(config, client=drive)
+            succeeded, failed = reports.data_upload(gdrive, wordpress, config, spreadsheets, workbooks, checkpoint)
+            result['data_upload_seconds'] = time.perf_counter() - start
+            workbooks.close()
+
+            result['total_seconds'] = result['wordpress_seconds'] + result['create_spreadsheets_seconds'] + result['data_upload_seconds']
+            result['spreadsheets'] = len(spreadsheets)
+            result['builds_failed'] = len(build_failed)
+            result['uploads_failed'] = len(failed)
+            result['drive_api_calls'] = drive.calls
+            result['members_per_second'] = members / result['total_seconds']
+
+            # Release the log file before the working directory is removed
+            for handler in list(reports.logger.handlers):
+                reports.logger.removeHandler(handler)
+                handler.close()
+    finally:
+        server.close()
+
+    return result
+
+def run_startup(runs):
+    # Time a cold import of the module with python -X importtime and a cold run of --help, keeping the fastest of
+    # several runs. Also lists the heaviest packages the import pulled in
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    import_times = []
+    help_times = []
+    packages = {}
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import club_membership_reports'],
+                                 cwd=script_dir, capture_output=True, text=True, check=True)
+        for line in process.stderr.splitlines():
+            match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)', line)
+            if not match:
+                continue
+            cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+            if name == 'club_membership_reports':
+                import_times.append(cumulative / 1e6)
+            elif indent == 3:
+                # Packages imported directly by the module
+                packages[name] = min(packages.get(name, cumulative), cumulative)
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'club_membership_reports.py', '--help'], cwd=script_dir, capture_output=True, check=True)
+        help_times.append(time.perf_counter() - start)
+
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:5]
+    return {
+        'benchmark': 'startup',
+        'import_seconds': min(import_times),
+        'help_seconds': min(help_times),
+        'heaviest_imports': {name: cumulative / 1e6 for name, cumulative in heaviest},
+    }
+
+def check_baseline(results, baseline, tolerance):
+    # A stage regresses when it is slower than the baseline for the same scenario by more than the tolerance
+    regressions = []
+    previous = {(result.get('benchmark'), result.get('members'), result.get('clubs')): result for result in baseline}
+    for result in results:
+        base = previous.get((result.get('benchmark'), result.get('members'), result.get('clubs')))
+        if base is None:
+            continue
+        if result.get('benchmark') == 'startup':
+            name, stages = 'startup', ('import_seconds', 'help_seconds')
+        else:
+            name, stages = f'{result["members"]}:{result["clubs"]}', ('wordpress_seconds', 'create_spreadsheets_seconds', 'data_upload_seconds', 'total_seconds')
+        for stage in stages:
+            if result[stage] > base[stage] * (1 + tolerance):
+                regressions.append(f'{name} {stage} {base[stage]:.2f}s -> {result[stage]:.2f}s')
+    return regressions
+
+def scenario(value):
+    members, clubs = value.split(':')
+    return int(members), int(clubs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark club_membership_reports against local fakes of Wordpress and Google Drive')
+    parser.add_argument('--scenario', action='append', type=scenario, metavar='MEMBERS:CLUBS',
+                        help='scenario size, can be repeated (default: 10000:10 and 100000:500)')
+    parser.add_argument('--workers', type=int, default=8, help='Google Drive upload workers')
+    parser.add_argument('--processes', type=int, default=1, help='spreadsheet build processes')
+    parser.add_argument('--autofit-sample-rows', type=int, default=0, help='autofit sample size, 0 measures every row')
+    parser.add_argument('--in-memory', action='store_true', help='build and upload workbooks in memory')
+    parser.add_argument('--memory-budget-mb', type=int, default=512, help='in-memory workbook budget before spilling to disk')
+    parser.add_argument('--resumable-threshold-mb', type=float, default=5, help='size above which uploads are chunked')
+    parser.add_argument('--chunk-size-mb', type=float, default=8, help='resumable upload chunk size')
+    parser.add_argument('--batch-size', type=int, default=100, help='Drive calls per batch request')
+    parser.add_argument('--drive-latency', type=float, default=0, help='seconds added to every fake Drive API call')
+    parser.add_argument('--wordpress-latency', type=float, default=0, help='seconds the fake server takes to generate an export')
+    parser.add_argument('--startup', action='store_true', help='measure import and --help time instead of running scenarios')
+    parser.add_argument('--startup-runs', type=int, default=5, help='startup measurements, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results saved with --save and exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline (default: 0.25)')
+    args = parser.parse_args()
+
+    results = []
+    if args.startup:
+        result = run_startup(args.startup_runs)
+        results.append(result)
+        print(f'import {result["import_seconds"]:.3f}s  --help {result["help_seconds"]:.3f}s')
+        for name, seconds in result['heaviest_imports'].items():
+            print(f'  {name:<24} {seconds:.3f}s')
+
+    for members, clubs in [] if args.startup else args.scenario or [(10000, 10), (100000, 500)]:
+        result = run_scenario(members, clubs, args)
+        results.append(result)
+        print(f'{members:>8} members {clubs:>5} clubs  '
+              f'wordpress {result["wordpress_seconds"]:7.2f}s  '
+              f'spreadsheets {result["create_spreadsheets_seconds"]:7.2f}s  '
+              f'upload {result["data_upload_seconds"]:7.2f}s  '
+              f'total {result["total_seconds"]:7.2f}s  '
+              f'{result["members_per_second"]:9.0f} members/s  '
+              f'{result["drive_api_calls"]} Drive calls')
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = check_baseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
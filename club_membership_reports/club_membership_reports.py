@@ -8,18 +8,47 @@ config.yaml, client_secrets.json, and gdrive_auth.txt files are prerequisites. S
 Logs are saved to ./output.log
 '''
 
-import pandas as pd
-import yaml
 import os
 import io
+import json
+import argparse
+import hashlib
+import time
+import datetime
+import random
 import logging
-import requests
-import pydrive.auth
-import pydrive.drive
-from urllib3.util import Retry
-from openpyxl import load_workbook
-from openpyxl.worksheet.table import Table
-from openpyxl.utils import get_column_letter
+import warnings
+import contextlib
+import tempfile
+import threading
+import importlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class LazyModule():
+    # Stands in for a heavy dependency until its first use, so that --help and runs that skip a stage do not pay
+    # for importing it. Submodules such as pydrive.auth or googleapiclient.errors are imported on first use too
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.name)
+        if not hasattr(module, attr):
+            importlib.import_module(f'{self.name}.{attr}')
+        return getattr(module, attr)
+
+pd = LazyModule('pandas')
+yaml = LazyModule('yaml')
+requests = LazyModule('requests')
+urllib3 = LazyModule('urllib3')
+httplib2 = LazyModule('httplib2')
+pydrive = LazyModule('pydrive')
+googleapiclient = LazyModule('googleapiclient')
+openpyxl = LazyModule('openpyxl')
+
+# Set by the --serve mode. Login, download and authorization errors then raise, so that the service can log the failed
+# run and try again later, instead of exiting the process
+service_mode = False
 
 def create_logger(working_dir):
     filepath = f'{working_dir}/output.log'
@@ -32,6 +61,82 @@ def create_logger(working_dir):
 
     return log
 
+class Metrics():
+    # Run metrics, written to metrics.json (and optionally a Prometheus textfile) at the end of the run
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.spreadsheets = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Time a pipeline stage. Stages entered more than once accumulate
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+            logger.info(f'{name} took {elapsed:.1f}s')
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def spreadsheet(self, filename, name, value):
+        # Per spreadsheet (and so per club) measurements such as build and upload time
+        with self.lock:
+            self.spreadsheets.setdefault(filename, {})[name] = value
+
+    def write(self, config):
+        data = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'duration_seconds': time.time() - self.started,
+            'stages': self.stages,
+            'counters': self.counters,
+            'spreadsheets': self.spreadsheets,
+        }
+        try:
+            with open(config.path('metrics.json'), 'w') as file:
+                json.dump(data, file, indent=2)
+        except:
+            logger.exception('failed to save metrics.json')
+
+        if config.metrics_textfile:
+            self.write_textfile(config.metrics_textfile, data)
+
+    def write_textfile(self, path, data):
+        # Prometheus text exposition format, for node_exporter's textfile collector
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = [
+            '# TYPE club_reports_duration_seconds gauge',
+            f'club_reports_duration_seconds {data["duration_seconds"]}',
+            '# TYPE club_reports_last_run_timestamp_seconds gauge',
+            f'club_reports_last_run_timestamp_seconds {self.started}',
+            '# TYPE club_reports_stage_seconds gauge',
+        ]
+        lines += [f'club_reports_stage_seconds{{stage="{label(stage)}"}} {value}' for stage, value in data['stages'].items()]
+        for name, value in data['counters'].items():
+            lines += [f'# TYPE club_reports_{name} gauge', f'club_reports_{name} {value}']
+        for name in ('build_seconds', 'upload_seconds'):
+            lines.append(f'# TYPE club_reports_spreadsheet_{name} gauge')
+            for filename, values in data['spreadsheets'].items():
+                if name in values:
+                    lines.append(f'club_reports_spreadsheet_{name}{{spreadsheet="{label(filename)}"}} {values[name]}')
+
+        # Write to a temporary file first so the collector never reads a partial file
+        try:
+            with open(f'{path}.tmp', 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            os.replace(f'{path}.tmp', path)
+        except:
+            logger.exception(f'failed to save metrics textfile {path}')
+
 class Config():
     def __init__(self, filepath):
         # Load config.yaml file
@@ -51,14 +156,82 @@ class Config():
         self.password = data['wordpress']['password']
         self.membership_url = data['wordpress']['membership_url']
         self.orders_url = data['wordpress']['orders_url']
+
+        # Optional CSV parsing settings. By default every column is loaded and pandas infers the types
+        self.membership_columns = data['wordpress'].get('membership_columns')
+        self.membership_dtypes = data['wordpress'].get('membership_dtypes') or {}
+        self.orders_columns = data['wordpress'].get('orders_columns')
+        self.orders_dtypes = data['wordpress'].get('orders_dtypes') or {}
+
+        # Optional incremental orders sync. Only orders newer than the saved snapshot are downloaded
+        self.incremental_orders = data['wordpress'].get('incremental_orders', False)
+        self.orders_resync_days = data['wordpress'].get('orders_resync_days', 30)
+        self.orders_id_column = data['wordpress'].get('orders_id_column', 'id')
+        self.orders_timestamp_column = data['wordpress'].get('orders_timestamp_column', 'timestamp')
         self.club_folders_id = data['google_drive']['club_folders_id']
         self.reports_folder_id = data['google_drive']['reports_folder_id']
 
+        # Optional upload tuning. Older config files without these keys upload one file at a time
+        self.upload_workers = data['google_drive'].get('upload_workers', 1)
+        self.requests_per_second = data['google_drive'].get('requests_per_second', 0)
+        self.max_retries = data['google_drive'].get('max_retries', 5)
+        self.id_cache = data['google_drive'].get('id_cache', True)
+        self.resumable_threshold_mb = data['google_drive'].get('resumable_threshold_mb', 5)
+        self.chunk_size_mb = data['google_drive'].get('chunk_size_mb', 8)
+        self.batch_size = data['google_drive'].get('batch_size', 100)
+
+        # Optional report settings
+        reports = data.get('reports') or {}
+        self.incremental = reports.get('incremental', False)
+        self.autofit_sample_rows = reports.get('autofit_sample_rows', 0)
+        self.spreadsheet_workers = reports.get('workers', 1)
+        self.in_memory = reports.get('in_memory', False)
+        self.memory_budget_mb = reports.get('memory_budget_mb', 512)
+
+        # Optional snapshots of each run's membership and orders data. 0 keeps no snapshots
+        snapshots = data.get('snapshots') or {}
+        self.snapshots_keep = snapshots.get('keep', 0)
+
+        # Optional Prometheus textfile for the run metrics, in addition to metrics.json
+        self.metrics_textfile = (data.get('metrics') or {}).get('textfile', '')
+
+        # Optional service mode settings, used when running with --serve
+        service = data.get('service') or {}
+        self.interval_minutes = service.get('interval_minutes', 60)
+        self.run_on_start = service.get('run_on_start', True)
+        self.trigger_host = service.get('host', '127.0.0.1')
+        self.trigger_port = service.get('port', 8765)
+        self.session_hours = service.get('session_hours', 12)
+        self.token_refresh_minutes = service.get('token_refresh_minutes', 10)
+
     def path(self, filename):
         return f'{self.working_dir}/{filename}'
 
 class Wordpress():
-    def __init__(self, config):
+    def __init__(self, config, client=None):
+        # A logged in session, such as the one the service mode keeps warm, can be passed in to skip the login
+        self.client = client if client is not None else self.login(config)
+
+        # Get membership and orders data. The exports do not depend on each other, so download them at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            exports = [executor.submit(self.membership, config), executor.submit(self.orders, config)]
+            for export in exports:
+                export.result()
+
+        # Get club list from membership data
+        self.club_list()
+
+        # Close the connection, unless it belongs to the caller
+        if client is None:
+            self.client.close()
+
+    @classmethod
+    def connect(cls, config):
+        # Log in without downloading anything, returning the session for later Wordpress(config, client) runs
+        wordpress = cls.__new__(cls)
+        return wordpress.login(config)
+
+    def login(self, config):
         login_data = {
             'log':config.username, 
             'pwd':config.password, 
@@ -67,7 +240,7 @@ class Wordpress():
             "rememberme": "forever", 
             'testcookie':'1' 
         }
-        retry = Retry(
+        retry = urllib3.util.Retry(
             total=5,
             backoff_factor=2,
             status_forcelist=[408, 429, 500, 502, 503, 504],
@@ -81,19 +254,19 @@ class Wordpress():
         self.client =  client
 
         # Authenticate with Wordpress server
-        login = self.http_post(config.wp_login, 'successfully logged into Wordpress', data=login_data)
-
-        # Get membership data
-        self.membership(config)
+        with metrics.stage('wordpress_login'):
+            login = self.http_post(config.wp_login, 'successfully logged into Wordpress', data=login_data)
 
-        # Get club list from membership data
-        self.club_list()
-
-        # Get orders data
-        self.orders(config)
+        return client
 
-        # Close the connection
-        self.client.close()
+    @classmethod
+    def from_frames(cls, membership, orders):
+        # Build from previously downloaded exports without contacting the Wordpress server
+        wordpress = cls.__new__(cls)
+        wordpress.membership = membership
+        wordpress.orders = orders
+        wordpress.club_list()
+        return wordpress
 
     def http_post(self, url, success_message, **kwargs):
         if 'data' in kwargs.keys():
@@ -101,61 +274,188 @@ class Wordpress():
         else:
             data = {}
 
+        # Streamed responses return once the headers arrive, leaving the body to be read by the caller
+        if 'stream' in kwargs.keys():
+            stream = kwargs['stream']
+        else:
+            stream = False
+
         try:
-            response = self.client.post(url, data=data, allow_redirects=True, timeout=180)
-            if response.ok:
-                logger.info(success_message)
+            response = self.client.post(url, data=data, allow_redirects=True, timeout=180, stream=stream)
+
+            # Count the request along with any retries urllib3 made before it returned
+            metrics.count('wordpress_requests')
+            retries = getattr(response.raw, 'retries', None)
+            if retries:
+                metrics.count('wordpress_retries', len(retries.history))
+
+            # An error page must not be parsed as an export
+            response.raise_for_status()
+            logger.info(success_message)
         except:
             logger.exception(f'failed POST to url: {url}')
             self.client.close()
+            if service_mode:
+                raise
             os._exit(0)
 
         return response
     
     def membership(self, config):
-        # Download the membership CSV file from the Paid Membership Pro plugin
-        membership_response = self.http_post(config.membership_url, 'successfully downloaded membership CSV file')
-        
-        # Decode and create Membership CSV
-        membership_raw_data = self.decode(membership_response)
-        membership_data = self.create_csv(membership_raw_data)
+        with metrics.stage('membership_export'):
+            self.membership = self.membership_export(config)
+
+    def membership_export(self, config):
+        # Request the membership CSV file from the Paid Membership Pro plugin
+        membership_response = self.http_post(config.membership_url, 'started downloading membership CSV file', stream=True)
+
+        # Parse the Membership CSV as it downloads. Club names are always read as text
+        dtypes = {'home_club': str, **config.membership_dtypes}
+        membership_data = self.create_csv(membership_response, config.membership_columns, dtypes)
+        if membership_data is None:
+            raise RuntimeError('failed to read the membership CSV export from Wordpress')
+
+        # Wordpress answers some failed exports with a 200 and a body such as "0", which parses as a CSV without
+        # any of the membership columns
+        if 'home_club' not in membership_data.columns:
+            raise RuntimeError('membership CSV export from Wordpress has no home_club column')
         logger.info(f'{len(membership_data)} members found in data')
 
-        self.membership = membership_data
-    
-    def orders(self, config):
-        # Download orders CSV file from the Paid Membership Pro plugin
-        orders_response = self.http_post(config.orders_url, 'successfully downloaded orders CSV file')
+        return membership_data
 
-        # Decode and create Orders CSV
-        orders_raw_data = self.decode(orders_response)
-        orders_data = self.create_csv(orders_raw_data)
+    def orders(self, config):
+        with metrics.stage('orders_export'):
+            self.orders = self.orders_export(config)
+
+    def orders_export(self, config):
+        # The orders history only grows, so in incremental mode only the tail of it is downloaded
+        snapshot = None
+        request_data = {}
+        if config.incremental_orders:
+            snapshot = load_snapshot(config.path('orders_sync.parquet'))
+            if snapshot is not None:
+                request_data = self.orders_filter(config, snapshot)
+
+        # Request the orders CSV file from the Paid Membership Pro plugin
+        orders_response = self.http_post(config.orders_url, 'started downloading orders CSV file', data=request_data, stream=True)
+
+        # Parse the Orders CSV as it downloads
+        orders_data = self.create_csv(orders_response, config.orders_columns, config.orders_dtypes)
+
+        if snapshot is not None:
+            if orders_data is None:
+                logger.error('failed to sync new orders, using the saved orders snapshot')
+                orders_data = snapshot
+            else:
+                logger.info(f'{len(orders_data)} new or updated orders downloaded')
+                orders_data = self.merge_orders(config, snapshot, orders_data)
+
+        if orders_data is None:
+            raise RuntimeError('failed to read the orders CSV export from Wordpress')
+
+        if config.incremental_orders and orders_data is not snapshot:
+            save_snapshot(orders_data, config.path('orders_sync.parquet'))
+
+        logger.info(f'{len(orders_data)} orders found in data')
+
+        return orders_data
+
+    def orders_filter(self, config, snapshot):
+        # Ask for the orders placed since the newest saved order. The window reaches back orders_resync_days
+        # further so that recent orders whose status changed (refunds, cancellations) are picked up again
+        timestamps = pd.to_datetime(snapshot[config.orders_timestamp_column], errors='coerce')
+        if timestamps.isna().all():
+            return {}
+        since = timestamps.max() - pd.Timedelta(days=config.orders_resync_days)
+        until = pd.Timestamp.now() + pd.Timedelta(days=1)
+        logger.info(f'syncing orders placed since {since:%Y-%m-%d}')
+
+        return {
+            'filter': 'within-a-date-range',
+            'start-month': since.month,
+            'start-day': since.day,
+            'start-year': since.year,
+            'end-month': until.month,
+            'end-day': until.day,
+            'end-year': until.year,
+        }
 
-        self.orders = orders_data
+    def merge_orders(self, config, snapshot, orders_data):
+        # Newly downloaded rows replace saved rows with the same order ID
+        merged = pd.concat([snapshot, orders_data], ignore_index=True)
+        merged = merged.drop_duplicates(subset=config.orders_id_column, keep='last')
+        return merged.sort_values(config.orders_id_column, ignore_index=True)
 
     def club_list(self):
-        # Get unique club names from membership list
-        try:
-            self.club_list = set(self.membership['home_club'])
-            logger.info(f'{len(self.club_list)} clubs found in data')
-        except:
-            logger.exception('failed to get club list from csv data')
+        # Split the membership data by home club in a single pass, leaving out members without a known club. Without
+        # the home_club column every club would look empty, so the run stops instead
+        if 'home_club' not in self.membership.columns:
+            raise RuntimeError('failed to get club list from csv data: no home_club column')
+
+        self.club_data = {}
+        for club, club_data in self.membership.groupby('home_club', sort=False):
+            if 'unknown' not in club.lower():
+                self.club_data[club] = club_data
+        self.club_list = set(self.club_data)
+        logger.info(f'{len(self.club_list)} clubs found in data')
+
+    def clubs(self):
+        # Iterate over (club, membership data) pairs
+        return iter(self.club_data.items())
     
-    def decode(self, response):
-        try:
-            return response.content.decode('utf8')
-        except:
-            logger.exception(f'failed to decode response data')
-
-    def create_csv(self, data):
+    def create_csv(self, response, columns=None, dtypes=None):
+        # Returns None when the export cannot be read, including a timeout partway through the streamed body
         try:
-            return pd.read_csv(io.StringIO(data))
+            with response:
+                # Let urllib3 undo any gzip transfer encoding, then parse straight from the raw byte stream
+                response.raw.decode_content = True
+                data = pd.read_csv(response.raw, usecols=columns, dtype=dtypes, encoding='utf8')
+                metrics.count('wordpress_bytes', response.raw.tell())
+                return data
         except:
             logger.exception(f'failed to create Pandas dataframe from CSV data')
 
 
+class RateLimiter():
+    def __init__(self, requests_per_second):
+        # Spread requests evenly so that all upload workers together stay under the API quota
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_request = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        # Reserve the next free time slot, then sleep outside of the lock until it arrives
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_request)
+            self.next_request = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
 class GoogleDrive():
-    def __init__(self, config):
+    # HTTP status codes that Google recommends retrying with exponential backoff
+    retry_statuses = (429, 500, 502, 503, 504)
+    retry_reasons = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+    def __init__(self, config, client=None):
+        self.rate_limiter = RateLimiter(config.requests_per_second)
+        self.max_retries = config.max_retries
+        self.resumable_threshold = config.resumable_threshold_mb * 1024 * 1024
+
+        # Resumable upload chunks must be a multiple of 256 KB
+        self.chunk_size = max(1, round(config.chunk_size_mb * 4)) * 256 * 1024
+
+        # Google Drive accepts at most 100 calls in one batch request
+        self.batch_size = min(max(1, config.batch_size), 100)
+
+        # An already authorized pydrive client (or a stand-in for benchmarks) can be passed in
+        self.client = client if client is not None else self.authorize(config)
+
+    def authorize(self, config):
         gauth = pydrive.auth.GoogleAuth()
 
         # Load saved client credentials (does not exist when running this for the first time)
@@ -173,6 +473,8 @@ class GoogleDrive():
                 logger.info('authenticated with Google Cloud API')
             except:
                 logger.exception('failed to authenticate with Google Cloud API')
+                if service_mode:
+                    raise
                 os._exit(0)
 
         elif gauth.access_token_expired:
@@ -182,6 +484,8 @@ class GoogleDrive():
                 logger.info('refreshed the Google Cloud API token')
             except:
                 logger.exception('failed to refresh the Google Cloud API token')
+                if service_mode:
+                    raise
                 os._exit(0)
         else:
 
@@ -190,6 +494,8 @@ class GoogleDrive():
                 logger.info('loaded the cached Google Cloud API token')
             except:
                 logger.exception('failed to load the cached Google Cloud API token')
+                if service_mode:
+                    raise
                 os._exit(0)
 
         # Save the current credentials to file for the next time the script is ran
@@ -198,15 +504,151 @@ class GoogleDrive():
         except:
             logger.exception('failed to save gdrive credentials file')
 
-        self.client = pydrive.drive.GoogleDrive(gauth)
+        return pydrive.drive.GoogleDrive(gauth)
+
+    def refresh(self, config, margin):
+        # Renew the access token when it expires within margin seconds, so that a run never starts on a stale token
+        gauth = self.client.auth
+        expiry = getattr(gauth.credentials, 'token_expiry', None)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if expiry is None or expiry - now > datetime.timedelta(seconds=margin):
+            return
+
+        try:
+            gauth.Refresh()
+            gauth.SaveCredentialsFile(f'{config.path('gdrive_auth.txt')}')
+            logger.info('refreshed the Google Cloud API token')
+        except:
+            logger.exception('failed to refresh the Google Cloud API token')
+
+    def http_error(self, error):
+        # File uploads wrap the googleapiclient HttpError in a pydrive ApiRequestError, file listings do not
+        if isinstance(error, googleapiclient.errors.HttpError):
+            return error
+        return error.args[0] if error.args else None
+
+    def error_status(self, error):
+        return getattr(getattr(self.http_error(error), 'resp', None), 'status', None)
+
+    def should_retry(self, error):
+        status = self.error_status(error)
+        if status in self.retry_statuses:
+            return True
+        if status == 403:
+            return any(reason in str(self.http_error(error)) for reason in self.retry_reasons)
+        return False
+
+    def request(self, action, *args, **kwargs):
+        # Run a Google Drive API call under the shared rate limit, retrying throttled and server errors
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            metrics.count('drive_api_calls')
+            try:
+                return action(*args, **kwargs)
+            except (pydrive.files.ApiRequestError, googleapiclient.errors.HttpError) as error:
+                if attempt >= self.max_retries or not self.should_retry(error):
+                    raise
+                delay = 2 ** attempt + random.random()
+                attempt += 1
+                metrics.count('drive_retries')
+                logger.warning(f'Google Drive request throttled or failed ({error}), retry {attempt} of {self.max_retries} in {delay:.1f}s')
+                time.sleep(delay)
+
+    def batch(self, requests):
+        # Send API requests in Drive batch requests of up to batch_size calls, so that many metadata changes cost
+        # one round trip. Returns a (response, error) pair per request. Items that were throttled or hit a server
+        # error are sent again together with backoff, any other failure is returned for the caller to handle
+        results = [(None, None)] * len(requests)
+        pending = list(range(len(requests)))
+        attempt = 0
+        while True:
+            retry = []
+            for start in range(0, len(pending), self.batch_size):
+                retry += self.send_batch(requests, pending[start:start + self.batch_size], results)
+            if not retry or attempt >= self.max_retries:
+                return results
+
+            delay = 2 ** attempt + random.random()
+            attempt += 1
+            metrics.count('drive_retries', len(retry))
+            logger.warning(f'{len(retry)} of {len(pending)} batched Google Drive requests throttled or failed, retry {attempt} of {self.max_retries} in {delay:.1f}s')
+            time.sleep(delay)
+            pending = retry
+
+    def send_batch(self, requests, indexes, results):
+        # Run one batch request, storing each item's result and returning the indexes worth retrying
+        retry = []
+
+        def callback(request_id, response, error):
+            index = int(request_id)
+            results[index] = (response, error)
+            if error is not None and self.should_retry(error):
+                retry.append(index)
+
+        batch = self.client.auth.service.new_batch_http_request(callback=callback)
+        for index in indexes:
+            batch.add(requests[index], request_id=str(index))
+
+        self.rate_limiter.wait()
+        metrics.count('drive_api_calls')
+        metrics.count('drive_batch_items', len(indexes))
+        try:
+            batch.execute(http=self.client.auth.Get_Http_Object())
+        except (googleapiclient.errors.HttpError, httplib2.HttpLib2Error, OSError) as error:
+            # The batch request itself failed, so every item in it failed the same way
+            for index in indexes:
+                results[index] = (None, error)
+            if isinstance(error, googleapiclient.errors.HttpError) and not self.should_retry(error):
+                return []
+            return list(indexes)
+
+        return retry
+
+    def search(self, query):
+        # Fetch every page of results for a Drive query, using the largest page size the API allows. With maxResults
+        # set, pydrive's GetList returns a single page and stores the next page token, which is None after the last
+        # page. Each page is its own rate limited and retried request
+        file_list = self.client.ListFile({'q': query, 'maxResults': 1000})
+        files = []
+        while file_list.get('pageToken', '') is not None:
+            files.extend(self.request(file_list.GetList))
+        return files
+
+    def search_many(self, queries):
+        # Run several Drive queries with batched requests, following further pages of results in later batches
+        if len(queries) == 1:
+            return [self.search(queries[0])]
+
+        files = self.client.auth.service.files()
+        results = [[] for _ in queries]
+        page_tokens = {index: None for index in range(len(queries))}
+        while page_tokens:
+            indexes = list(page_tokens)
+            requests = []
+            for index in indexes:
+                params = {'q': queries[index], 'maxResults': 1000}
+                if page_tokens[index]:
+                    params['pageToken'] = page_tokens[index]
+                requests.append(files.list(**params))
+
+            page_tokens = {}
+            for index, (response, error) in zip(indexes, self.batch(requests)):
+                if error is not None:
+                    raise error
+                results[index].extend(response.get('items', []))
+                if response.get('nextPageToken'):
+                    page_tokens[index] = response['nextPageToken']
+
+        return results
 
     def list_contents(self, id):
         try:
-            return self.client.ListFile({'q': f"'{id}' in parents and trashed=false"}).GetList()
+            return self.search(f"'{id}' in parents and trashed=false")
         except:
             logger.exception(f'failed to get list of items from Google Drive for folder id: {id}')
     
-    def create_file(self, path, filename, parent, id):
+    def create_file(self, content, filename, parent, id):
 
         if id:
             file_metadata = {
@@ -215,26 +657,30 @@ class GoogleDrive():
                 'parents': [{'id': parent}]
             }
         else:
-            logger.info(f'no club spreadsheet found. Creating...')
+            logger.info(f'no {filename} found. Creating...')
             # Leave ID out of the metadata so that a new file is created
             file_metadata = {
                 'title': filename,
-                'parents': parent
+                'parents': [{'id': parent}]
             }
 
         # Create a Google Drive File with metadata
         file = self.client.CreateFile(file_metadata)
 
-        # Add content from the Excel file
-        file.SetContentFile(path)
+        # Add content from the Excel file, either a path or an in-memory buffer
+        if isinstance(content, str):
+            file.SetContentFile(content)
+        else:
+            file.content = content
+            file['mimeType'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
         return file
 
     def create_folder(self, club, id):
         folder_metadata = {
             'title': club,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': id
+            'mimeType': DriveIndex.folder_mime_type,
+            'parents': [{'id': id}]
         }
         folder = self.client.CreateFile(folder_metadata)
         folder = self.upload(folder, f'{club} folder successfully created')
@@ -242,152 +688,950 @@ class GoogleDrive():
         logger.info(f'club folder id: {club_folder_id}')
 
         return club_folder_id
+
+    def create_folders(self, titles, parent):
+        # Create many folders under one parent with batched requests. Returns the IDs of the folders created by
+        # title; failures are logged and left out so that the caller can create those one at a time
+        files = self.client.auth.service.files()
+        requests = []
+        for title in titles:
+            folder_metadata = {
+                'title': title,
+                'mimeType': DriveIndex.folder_mime_type,
+                'parents': [{'id': parent}]
+            }
+            requests.append(files.insert(body=folder_metadata, fields='id'))
+
+        folders = {}
+        for title, (response, error) in zip(titles, self.batch(requests)):
+            if error is not None:
+                logger.error(f'failed to create the {title} folder in Google Drive: {error}')
+                continue
+            folders[title] = response['id']
+
+        logger.info(f'created {len(folders)} of {len(titles)} folders in Google Drive')
+        return folders
     
+    def upload_file(self, file, size):
+        # Upload a file's content, switching to a chunked resumable upload for large files
+        start = time.monotonic()
+        if size >= self.resumable_threshold:
+            self.upload_resumable(file, size)
+        else:
+            self.request(file.Upload)
+
+        elapsed = time.monotonic() - start
+        logger.info(f'{file["title"]}: {size / 1024 / 1024:.1f} MB in {elapsed:.1f}s ({size / 1024 / 1024 / max(elapsed, 0.001):.2f} MB/s)')
+
+    def upload_resumable(self, file, size):
+        # Send the content in chunk_size pieces over a resumable upload session. When a chunk fails, only that
+        # chunk is retried: the upload picks up from the last byte Google Drive confirmed instead of starting over
+        media = googleapiclient.http.MediaIoBaseUpload(file.content, file.get('mimeType') or 'application/octet-stream', chunksize=self.chunk_size, resumable=True)
+        files = self.client.auth.service.files()
+        if file.get('id'):
+            request = files.update(fileId=file['id'], body=file.GetChanges(), media_body=media)
+        else:
+            request = files.insert(body=file.GetChanges(), media_body=media)
+
+        # A separate HTTP object per upload keeps concurrent uploads thread safe
+        http = self.client.auth.Get_Http_Object()
+
+        response = None
+        attempt = 0
+        while response is None:
+            self.rate_limiter.wait()
+            metrics.count('drive_api_calls')
+            try:
+                status, response = request.next_chunk(http=http)
+                metrics.count('drive_upload_chunks')
+                attempt = 0
+            except (googleapiclient.errors.HttpError, httplib2.HttpLib2Error, OSError) as error:
+                if attempt >= self.max_retries or (isinstance(error, googleapiclient.errors.HttpError) and not self.should_retry(error)):
+                    raise
+                delay = 2 ** attempt + random.random()
+                attempt += 1
+                metrics.count('drive_retries')
+                logger.warning(f'{file["title"]} chunk upload failed ({error}), retry {attempt} of {self.max_retries} in {delay:.1f}s')
+                time.sleep(delay)
+
+        # Mark the pydrive file as uploaded, the same as file.Upload() would
+        file.uploaded = True
+        file.dirty['content'] = False
+        file.UpdateMetadata(response)
+
     def upload(self, file, message):
         try:
-            file.Upload()
+            self.request(file.Upload)
             logger.info(message)
             return file
         except:
             logger.exception(f'failed to upload item to Google Drive')
 
-def create_spreadsheets(config, wordpress):
+class DriveIndex():
+    folder_mime_type = 'application/vnd.google-apps.folder'
+
+    # Number of parent folders combined into a single files query, keeping the query string well under the API limit
+    parents_per_query = 50
+
+    def __init__(self, gdrive, root_id, cache_path=''):
+        self.gdrive = gdrive
+        self.root_id = root_id
+        self.cache_path = cache_path
+        self.folders = {}
+        self.files = {}
+        self.cached = set()
+        self.lock = threading.Lock()
+        self.listing_lock = threading.Lock()
+
+        cache = self.load_cache()
+
+        # Validate against the live folder list so that trashed or renamed club folders drop out of the cache
+        folder_list = gdrive.search(f"'{root_id}' in parents and mimeType='{self.folder_mime_type}' and trashed=false")
+        for folder in folder_list:
+            self.folders.setdefault(folder['title'], folder['id'])
+
+        # Reuse cached file IDs for folders that still exist under the same name, list the rest
+        missing = []
+        for title, id in self.folders.items():
+            if cache['folders'].get(title) == id and id in cache['files']:
+                self.files[id] = cache['files'][id]
+                self.cached.add(id)
+            else:
+                self.files[id] = {}
+                missing.append(id)
+
+        # Keep cached contents of folders outside of the root, such as the reports folder
+        for id, files in cache['files'].items():
+            if id not in self.files and id not in cache['folders'].values():
+                self.files[id] = files
+                self.cached.add(id)
+
+        self.list_folders(missing)
+        logger.info(f'indexed {len(self.folders)} folders in Google Drive, {len(self.folders) - len(missing)} from the ID cache')
+
+    def load_cache(self):
+        cache = {'root_id': self.root_id, 'folders': {}, 'files': {}}
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return cache
 
-    def make_xlsx(filename, sheet_name, data, **kwargs):
-        # Write the data to an Excel file in the current directory
         try:
-            data.to_excel(filename, sheet_name=sheet_name, index=False)
+            with open(self.cache_path, 'r') as file:
+                data = json.load(file)
         except:
-            logger.exception(f'failed to export {filename} spreadsheet to Excel file')
-
-        # Load the recently created excel spreadsheet
-        wb = load_workbook(filename)
-        ws = wb[sheet_name]
+            logger.exception('failed to load the Google Drive ID cache')
+            return cache
 
-        # Remove unneeded columns
-        if 'delete' in kwargs.keys():
-            ws.delete_cols(*kwargs['delete'])
+        # A cache built for a different club folders ID does not apply
+        if data.get('root_id') != self.root_id:
+            return cache
 
-        # Format the spreadsheet as a table
-        table = Table(displayName='Table1', ref='A1:' + get_column_letter(ws.max_column) + str(ws.max_row))
-        ws.add_table(table)
+        return data
 
-        # Autofit column width  
-        for column in ws.columns:
-            max_length = 0
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = max_length + 6
-            ws.column_dimensions[column[0].column_letter].width = adjusted_width
-        
-        # Save changes
-        wb.save(filename)
+    def save_cache(self):
+        if not self.cache_path:
+            return
 
-    # Create membership spreadsheet
-    make_xlsx(f'{config.path('members_list.xlsx')}', 'members', wordpress.membership)
+        with self.lock:
+            data = {'root_id': self.root_id, 'folders': self.folders, 'files': self.files}
+            try:
+                # Write aside and swap in, so that an interrupted save never leaves a truncated cache
+                with open(f'{self.cache_path}.tmp', 'w') as file:
+                    json.dump(data, file, indent=2)
+                os.replace(f'{self.cache_path}.tmp', self.cache_path)
+            except:
+                logger.exception('failed to save the Google Drive ID cache')
+
+    def list_folders(self, folder_ids):
+        # Index the files within the folders, querying many folders at a time instead of one call per folder and
+        # sending the queries together in batch requests
+        chunks = [folder_ids[start:start + self.parents_per_query] for start in range(0, len(folder_ids), self.parents_per_query)]
+        if not chunks:
+            return
+
+        queries = []
+        for chunk in chunks:
+            parents = ' or '.join(f"'{id}' in parents" for id in chunk)
+            queries.append(f"({parents}) and mimeType!='{self.folder_mime_type}' and trashed=false")
+
+        # Build the listings aside and publish them once complete, so that other workers never see a folder as
+        # indexed while its query is still running
+        listed = {id: {} for id in folder_ids}
+        for chunk, files in zip(chunks, self.gdrive.search_many(queries)):
+            for file in files:
+                for parent in file['parents']:
+                    if parent['id'] in chunk:
+                        listed[parent['id']].setdefault(file['title'], file['id'])
+
+        # Merge into any existing listing so that files added while a cached folder is relisted are kept
+        with self.lock:
+            for id, files in listed.items():
+                self.files.setdefault(id, {}).update(files)
+
+    def index_folder(self, folder_id):
+        # List a folder that is not indexed yet, such as the reports folder on a cold cache. Concurrent callers wait
+        # for the one listing instead of each finding the folder empty
+        if folder_id in self.files:
+            return
+        with self.listing_lock:
+            if folder_id not in self.files:
+                self.list_folders([folder_id])
+
+    def folder_id(self, title):
+        return self.folders.get(title, '')
+
+    def file_id(self, folder_id, title):
+        self.index_folder(folder_id)
+        id = self.files[folder_id].get(title, '')
+        if id or folder_id not in self.cached:
+            return id
+
+        # A cached listing misses files uploaded since it was saved, so check the live folder before reporting the
+        # file as missing and having a duplicate created. Each cached folder is relisted at most once per run
+        with self.listing_lock:
+            if folder_id in self.cached:
+                self.list_folders([folder_id])
+                self.cached.discard(folder_id)
+        return self.files[folder_id].get(title, '')
+
+    def add_folder(self, title, id):
+        with self.lock:
+            self.folders[title] = id
+            self.files.setdefault(id, {})
+
+    def add_file(self, folder_id, title, id):
+        with self.lock:
+            self.files.setdefault(folder_id, {})[title] = id
+
+    def remove_file(self, folder_id, title):
+        with self.lock:
+            self.files.get(folder_id, {}).pop(title, None)
+
+def make_xlsx(filename, sheet_name, data, sample_rows=0, delete=None):
+    # Runs in worker processes as well, so errors are raised to the caller rather than logged here.
+    # filename can also be a file object. Returns the build time in seconds
+    start = time.monotonic()
+
+    # Remove unneeded columns before writing, using the same (first column, count) as openpyxl's delete_cols
+    if delete:
+        first, count = delete
+        data = data.drop(columns=data.columns[first - 1:first - 1 + count])
+
+    # Stream the rows straight into a write-only workbook so the file is only written once
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+
+    # Autofit column width. Write-only sheets need their column settings before any rows
+    for index, width in enumerate(column_widths(data, sample_rows), 1):
+        ws.column_dimensions[openpyxl.utils.get_column_letter(index)].width = width
+
+    # Format the spreadsheet as a table
+    table = openpyxl.worksheet.table.Table(displayName='Table1', ref=f'A1:{openpyxl.utils.get_column_letter(max(len(data.columns), 1))}{len(data) + 1}')
+    table.tableColumns = [openpyxl.worksheet.table.TableColumn(id=index, name=str(column)) for index, column in enumerate(data.columns, 1)]
+    table.autoFilter = openpyxl.worksheet.filters.AutoFilter(ref=table.ref)
+    with warnings.catch_warnings():
+        # openpyxl always warns that write-only tables need their columns added manually, which is done above
+        warnings.simplefilter('ignore', UserWarning)
+        ws.add_table(table)
 
-    # Create orders spreadsheet
-    make_xlsx(f'{config.path('orders.xlsx')}', 'orders', wordpress.orders)
+    # Write the header and the data, leaving missing values as empty cells
+    ws.append([str(column) for column in data.columns])
+    for row in data.astype(object).where(data.notna(), None).itertuples(index=False, name=None):
+        ws.append(row)
 
-    # Create members spreadsheets for each club
-    for club in wordpress.club_list:
-        # Filter out 'unknown' home_club
-        if 'unknown' not in club.lower():
-            # Save to Excel
-            filename = f'{config.path(f"{club}.xlsx")}'
-            club_data = wordpress.membership[wordpress.membership['home_club'] == club]
+    # Save changes
+    wb.save(filename)
 
-            make_xlsx(filename, 'members', club_data, delete=(7, 7))
+    return time.monotonic() - start
 
+def build_xlsx(path, sheet_name, data, sample_rows=0, delete=None):
+    # Build the workbook at path, or in memory when no path is given. Returns the build time and the in-memory contents
+    if path:
+        return make_xlsx(path, sheet_name, data, sample_rows, delete), None
 
-def data_upload(gdrive, wordpress, config):
+    buffer = io.BytesIO()
+    seconds = make_xlsx(buffer, sheet_name, data, sample_rows, delete)
+    return seconds, buffer.getvalue()
 
-    # Get contents of Google Drive reports folder
-    file_list = gdrive.list_contents(config.reports_folder_id)
+class WorkbookStore():
+    # Built workbooks waiting to be uploaded. They are written to the working directory, or in in_memory mode
+    # kept in memory up to memory_budget_mb, with anything beyond the budget spilled to a temporary directory
+    def __init__(self, config):
+        self.config = config
+        self.memory_budget = config.memory_budget_mb * 1024 * 1024
+        self.memory_used = 0
+        self.buffers = {}
+        self.paths = {}
+        self.spill_dir = None
+        self.lock = threading.Lock()
+
+    def target(self, filename):
+        # Path for build_xlsx, empty to build in memory
+        return '' if self.config.in_memory else f'{self.config.path(filename)}'
+
+    def add(self, filename, content=None):
+        with self.lock:
+            if content is None:
+                self.paths[filename] = f'{self.config.path(filename)}'
+            elif self.memory_used + len(content) <= self.memory_budget:
+                self.buffers[filename] = content
+                self.memory_used += len(content)
+            else:
+                if self.spill_dir is None:
+                    self.spill_dir = tempfile.TemporaryDirectory(prefix='club_reports_')
+                    logger.info(f'workbook memory budget reached, spilling to {self.spill_dir.name}')
+                path = os.path.join(self.spill_dir.name, filename)
+                with open(path, 'wb') as file:
+                    file.write(content)
+                self.paths[filename] = path
+
+    def open(self, filename):
+        # Upload source for GoogleDrive.create_file, a fresh buffer or a path
+        if filename in self.buffers:
+            return io.BytesIO(self.buffers[filename])
+        return self.paths[filename]
+
+    def size(self, filename):
+        if filename in self.buffers:
+            return len(self.buffers[filename])
+        return os.path.getsize(self.paths[filename])
+
+    def discard(self, filename, keep_file=False):
+        # keep_file leaves a workbook written to the working directory in place. Memory is always released, and
+        # spilled workbooks are removed by close()
+        with self.lock:
+            if filename in self.buffers:
+                self.memory_used -= len(self.buffers.pop(filename))
+            elif filename in self.paths:
+                path = self.paths.pop(filename)
+                if not keep_file:
+                    os.remove(path)
+
+    def close(self):
+        # Remove the spilled workbooks. Workbooks written to the working directory are removed as they upload
+        if self.spill_dir is not None:
+            self.spill_dir.cleanup()
+            self.spill_dir = None
+
+def create_spreadsheets(config, wordpress, workbooks, checkpoint):
+    # Returns the built spreadsheets with their content hashes, and the spreadsheets that failed to build. In
+    # incremental mode, spreadsheets whose data matches the last upload are skipped
+    manifest = load_manifest(config) if config.incremental else {}
+    spreadsheets = {}
+    jobs = []
+    skipped = 0
+    resumed = 0
+
+    def add(filename, sheet_name, data, delete=None):
+        nonlocal skipped, resumed
+        digest = data_hash(data)
+        if manifest.get(filename) == digest:
+            skipped += 1
+            return
+
+        # When resuming, reuse the workbooks the failed run already built or uploaded
+        if checkpoint.reusable(filename, digest):
+            if not checkpoint.is_uploaded(filename):
+                workbooks.add(filename)
+            spreadsheets[filename] = digest
+            resumed += 1
+            return
+
+        jobs.append((filename, sheet_name, data, delete, digest))
 
-    # Get Google Drive file IDs for members_list.xlsx and orders.xlsx if they exist
-    members_list_id = ''
-    orders_id = ''
-    for file in file_list:
-        match file['title']:
-            case 'members_list.xlsx':
-                members_list_id = file['id']
-            case 'orders.xlsx':
-                orders_id = file['id']
+    # Create membership spreadsheet
+    add('members_list.xlsx', 'members', wordpress.membership)
 
+    # Create orders spreadsheet
+    add('orders.xlsx', 'orders', wordpress.orders)
 
-    # Create and upload members_list.xlsx file
-    filename = "members_list.xlsx"
-    filepath = f'{config.path(filename)}'
-    file = gdrive.create_file(filepath, filename, config.reports_folder_id, members_list_id)
-    file = gdrive.upload(file, f'{filename} successfully uploaded')
+    # Create members spreadsheets for each club
+    for club, club_data in wordpress.clubs():
+        add(f'{club}.xlsx', 'members', club_data, delete=(7, 7))
+
+    failed = []
+
+    def finished(filename, digest, error, result=(0, None)):
+        if error is None:
+            seconds, content = result
+            workbooks.add(filename, content)
+            spreadsheets[filename] = digest
+            checkpoint.built(filename, digest)
+            metrics.spreadsheet(filename, 'build_seconds', seconds)
+        else:
+            logger.error(f'failed to export {filename} spreadsheet to Excel file', exc_info=error)
+            failed.append(filename)
+
+    if config.spreadsheet_workers > 1:
+        # Spread the workbooks over worker processes. Each worker is only sent its own slice of the data,
+        # and the full members list and orders are queued first so they build alongside the clubs
+        with ProcessPoolExecutor(max_workers=config.spreadsheet_workers) as executor:
+            tasks = {}
+            for filename, sheet_name, data, delete, digest in jobs:
+                task = executor.submit(build_xlsx, workbooks.target(filename), sheet_name, data, config.autofit_sample_rows, delete)
+                tasks[task] = (filename, digest)
+
+            for task in as_completed(tasks):
+                filename, digest = tasks[task]
+                error = task.exception()
+                finished(filename, digest, error, None if error else task.result())
+    else:
+        for filename, sheet_name, data, delete, digest in jobs:
+            try:
+                result = build_xlsx(workbooks.target(filename), sheet_name, data, config.autofit_sample_rows, delete)
+                finished(filename, digest, None, result)
+            except Exception as error:
+                finished(filename, digest, error)
+
+    # Save the build results in full now that the stage is done
+    checkpoint.complete('spreadsheets')
+
+    metrics.count('spreadsheets_built', len(spreadsheets))
+    metrics.count('spreadsheets_skipped', skipped)
+    metrics.count('spreadsheets_failed', len(failed))
+    if config.incremental:
+        logger.info(f'{len(spreadsheets)} spreadsheets changed, {skipped} unchanged spreadsheets skipped')
+    if resumed:
+        logger.info(f'{resumed} spreadsheets reused from the previous run')
+    if failed:
+        logger.error(f'{len(failed)} spreadsheets failed to build: {", ".join(sorted(failed))}')
+
+    return spreadsheets, failed
+
+def column_widths(data, sample_rows=0):
+    # Very large sheets can be measured on a sample of rows, trading exact widths for speed
+    if sample_rows and len(data) > sample_rows:
+        data = data.sample(n=sample_rows, random_state=0)
+
+    # Widest value in each column, header included, plus some padding
+    widths = []
+    for index, column in enumerate(data.columns):
+        lengths = data.iloc[:, index].dropna().astype(str).str.len()
+        widths.append(max(len(str(column)), int(lengths.max()) if len(lengths) else 0) + 6)
+    return widths
+
+def load_snapshot(path):
+    # Saved DataFrame in Parquet format, or None when there is no usable snapshot
+    if not os.path.exists(path):
+        return None
+    try:
+        return pd.read_parquet(path)
+    except:
+        logger.exception(f'failed to load snapshot {path}')
+        return None
+
+def save_snapshot(data, path):
+    # Write to a temporary file first so that a crash never leaves a half written snapshot behind
+    try:
+        data.to_parquet(f'{path}.tmp', index=False, compression='zstd')
+        os.replace(f'{path}.tmp', path)
+    except:
+        logger.exception(f'failed to save snapshot {path}')
+
+class SnapshotStore():
+    # Each run is saved to snapshots/<YYYYMMDD-HHMMSS-microseconds>/ as one Parquet file per DataFrame
+    names = ('membership', 'orders')
 
-    # Clean up local copy of the club members spreadsheet
-    os.remove(filepath)
+    def __init__(self, config):
+        self.directory = config.path('snapshots')
+        self.keep = config.snapshots_keep
+
+    def runs(self):
+        # Saved runs, newest first
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted((run for run in os.listdir(self.directory) if not run.startswith('.')), reverse=True)
+
+    def save(self, wordpress):
+        # Two runs never share a directory, even when they start within the same clock tick. Names still sort by time
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        run = stamp
+        while True:
+            try:
+                os.mkdir(f'{self.directory}/{run}')
+                break
+            except FileExistsError:
+                run = f'{stamp}-{os.urandom(4).hex()}'
+        for name in self.names:
+            save_snapshot(getattr(wordpress, name), f'{self.directory}/{run}/{name}.parquet')
+        logger.info(f'saved membership and orders snapshot {run}')
+
+        self.prune()
+
+    def prune(self):
+        # Retention policy: only the newest snapshots are kept
+        for run in self.runs()[self.keep:]:
+            for name in self.names:
+                path = f'{self.directory}/{run}/{name}.parquet'
+                if os.path.exists(path):
+                    os.remove(path)
+            try:
+                os.rmdir(f'{self.directory}/{run}')
+                logger.info(f'removed snapshot {run}')
+            except OSError:
+                logger.exception(f'failed to remove snapshot {run}')
+
+    def load(self, name, n=0, columns=None):
+        # Load snapshot N (0 is the newest run). The file is memory mapped and only the requested columns are read
+        runs = self.runs()
+        if n >= len(runs):
+            raise IndexError(f'snapshot {n} does not exist, {len(runs)} snapshots saved')
+        return pd.read_parquet(f'{self.directory}/{runs[n]}/{name}.parquet', columns=columns, memory_map=True)
+
+def data_hash(data):
+    # Hash the column names and row contents so that any change to the data produces a new digest
+    digest = hashlib.sha256(','.join(map(str, data.columns)).encode('utf8'))
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def load_manifest(config):
+    # Content hashes of the spreadsheets as of their last successful upload
+    try:
+        with open(config.path('report_manifest.json'), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except:
+        logger.exception('failed to load report_manifest.json')
+        return {}
+
+def save_manifest(config, manifest):
+    try:
+        with open(config.path('report_manifest.json'), 'w') as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+    except:
+        logger.exception('failed to save report_manifest.json')
+
+def upload_spreadsheet(gdrive, workbooks, drive_index, folder_id, filename):
+    start = time.monotonic()
+    try:
+        # Overwrite the existing Google Drive file when its ID is known, otherwise create a new one
+        gfile_id = drive_index.file_id(folder_id, filename)
+        file = gdrive.create_file(workbooks.open(filename), filename, folder_id, gfile_id)
+        try:
+            gdrive.upload_file(file, workbooks.size(filename))
+        except (pydrive.files.ApiRequestError, googleapiclient.errors.HttpError) as error:
+            if not gfile_id or gdrive.error_status(error) != 404:
+                raise
+
+            # The cached file no longer exists. Look the folder up again and retry
+            logger.info(f'{filename} id {gfile_id} not found in Google Drive. Looking it up again...')
+            drive_index.list_folders([folder_id])
+            gfile_id = drive_index.file_id(folder_id, filename)
+            file = gdrive.create_file(workbooks.open(filename), filename, folder_id, gfile_id)
+            gdrive.upload_file(file, workbooks.size(filename))
+
+        # Updating a trashed file succeeds but leaves it in the trash, so upload a fresh copy instead
+        if gfile_id and file.get('labels', {}).get('trashed'):
+            logger.info(f'{filename} id {gfile_id} is in the trash. Creating...')
+            drive_index.remove_file(folder_id, filename)
+            file = gdrive.create_file(workbooks.open(filename), filename, folder_id, '')
+            gdrive.upload_file(file, workbooks.size(filename))
+
+        logger.info(f'{filename} successfully uploaded')
+        drive_index.add_file(folder_id, filename, file['id'])
+
+        metrics.count('drive_upload_bytes', workbooks.size(filename))
+        metrics.spreadsheet(filename, 'upload_seconds', time.monotonic() - start)
+    except:
+        # Keep the workbook of a failed upload in the working directory so that --resume can reuse it
+        workbooks.discard(filename, keep_file=True)
+        raise
+
+    # Clean up local copy of the spreadsheet
+    workbooks.discard(filename)
+
+def upload_club(gdrive, config, workbooks, drive_index, club):
+    logger.info(f'club name: {club}')
+
+    club_folder_id = drive_index.folder_id(club)
+    if not club_folder_id:
+        logger.info(f'no club folder found for {club}. Creating...')
+
+        # Create the club folder and record it so later lookups see it
+        club_folder_id = gdrive.create_folder(club, config.club_folders_id)
+        drive_index.add_folder(club, club_folder_id)
+
+    upload_spreadsheet(gdrive, workbooks, drive_index, club_folder_id, f'{club}.xlsx')
+
+def data_upload(gdrive, wordpress, config, spreadsheets, workbooks, checkpoint):
+
+    # Index the club folders and their spreadsheets, reusing the ID cache from previous runs where it is still valid
+    cache_path = f'{config.path('gdrive_cache.json')}' if config.id_cache else ''
+    with metrics.stage('drive_index'):
+        drive_index = DriveIndex(gdrive, config.club_folders_id, cache_path)
+
+        # List the reports folder before its two spreadsheets upload at the same time
+        if 'members_list.xlsx' in spreadsheets or 'orders.xlsx' in spreadsheets:
+            drive_index.index_folder(config.reports_folder_id)
+
+    # Save the IDs for the next run even when the uploads are interrupted, so that the folders and files created
+    # so far are found again instead of created twice
+    try:
+        # Create missing club folders up front in batch requests rather than one request per club upload. Any that
+        # fail here are created one at a time by upload_club
+        missing = [club for club, _ in wordpress.clubs() if f'{club}.xlsx' in spreadsheets and not checkpoint.is_uploaded(f'{club}.xlsx') and not drive_index.folder_id(club)]
+        if missing:
+            with metrics.stage('create_folders'):
+                for club, id in gdrive.create_folders(missing, config.club_folders_id).items():
+                    drive_index.add_folder(club, id)
+
+        # Spreadsheets uploaded before a resumed run failed are not uploaded again
+        succeeded = [filename for filename in spreadsheets if checkpoint.is_uploaded(filename)]
+        failed = []
+        if succeeded:
+            logger.info(f'{len(succeeded)} spreadsheets already uploaded by the previous run')
+
+        # Upload the reports and every club spreadsheet using a bounded pool of workers
+        with ThreadPoolExecutor(max_workers=max(1, config.upload_workers)) as executor:
+            tasks = {}
+            for filename in ('members_list.xlsx', 'orders.xlsx'):
+                if filename in spreadsheets and not checkpoint.is_uploaded(filename):
+                    task = executor.submit(upload_spreadsheet, gdrive, workbooks, drive_index, config.reports_folder_id, filename)
+                    tasks[task] = filename
+
+            # Only the club spreadsheets built by create_spreadsheets are uploaded
+            for club, _ in wordpress.clubs():
+                if f'{club}.xlsx' in spreadsheets and not checkpoint.is_uploaded(f'{club}.xlsx'):
+                    task = executor.submit(upload_club, gdrive, config, workbooks, drive_index, club)
+                    tasks[task] = f'{club}.xlsx'
+
+            for task in as_completed(tasks):
+                filename = tasks[task]
+                try:
+                    task.result()
+                    succeeded.append(filename)
+                    checkpoint.uploaded(filename)
+                except Exception as error:
+                    logger.error(f'failed to upload {filename}: {error}')
+                    failed.append(filename)
+    finally:
+        drive_index.save_cache()
+
+    # Record the content hashes of the uploaded spreadsheets. Failed uploads are retried next run
+    if config.incremental:
+        manifest = load_manifest(config)
+        manifest.update({filename: spreadsheets[filename] for filename in succeeded})
+        save_manifest(config, manifest)
+
+    # Summarize the run so that a single failure does not get lost in the log
+    logger.info(f'upload summary: {len(succeeded)} succeeded, {len(failed)} failed')
+    metrics.count('uploads_succeeded', len(succeeded))
+    metrics.count('uploads_failed', len(failed))
+    if failed:
+        logger.error(f'failed uploads: {", ".join(sorted(failed))}')
+
+    return succeeded, failed
+
+class Checkpoint():
+    # Journal of completed stages and uploads, so that a failed run can be picked up with --resume. checkpoint.json
+    # holds the state as of the last completed stage, and each build and upload since then is appended as one line
+    # to checkpoint.jsonl. The downloaded exports are kept in ./checkpoint as Parquet files until the run completes
+    def __init__(self, config, resume=False):
+        self.config = config
+        self.path = f'{config.path('checkpoint.json')}'
+        self.journal_path = f'{config.path('checkpoint.jsonl')}'
+        self.directory = f'{config.path('checkpoint')}'
+        self.lock = threading.Lock()
+        self.journal = None
+        self.load()
+
+        if not resume:
+            self.clear()
+        elif self.state['stages']:
+            logger.info(f'resuming previous run, completed stages: {", ".join(self.state["stages"])}, {len(self.state["uploaded"])} spreadsheets uploaded')
+        else:
+            logger.info('no checkpoint found, starting a new run')
 
-    # Create and upload members_list.xlsx file
-    filename = "orders.xlsx"
-    filepath = f'{config.path(filename)}'
-    file = gdrive.create_file(filepath, filename, config.reports_folder_id, orders_id)
-    file = gdrive.upload(file, f'{filename} successfully uploaded')
+    def load(self):
+        self.state = {'stages': [], 'spreadsheets': {}, 'uploaded': set()}
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as file:
+                    state = json.load(file)
+                self.state = {'stages': state['stages'], 'spreadsheets': state['spreadsheets'], 'uploaded': set(state['uploaded'])}
+
+            # Replay the events recorded since the last save. A line cut short by a crash is ignored
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'r') as file:
+                    for line in file:
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            continue
+                        if 'built' in event:
+                            self.state['spreadsheets'][event['built']] = event['digest']
+                        elif 'uploaded' in event:
+                            self.state['uploaded'].add(event['uploaded'])
+        except:
+            logger.exception('failed to load the checkpoint, starting a new run')
+            self.state = {'stages': [], 'spreadsheets': {}, 'uploaded': set()}
 
-    # Clean up local copy of the club members spreadsheet
-    os.remove(filepath)
+    def save(self):
+        # Write the full state and start an empty journal. Only done at stage boundaries
+        with self.lock:
+            try:
+                state = {'stages': self.state['stages'], 'spreadsheets': self.state['spreadsheets'], 'uploaded': sorted(self.state['uploaded'])}
+                with open(f'{self.path}.tmp', 'w') as file:
+                    json.dump(state, file)
+                os.replace(f'{self.path}.tmp', self.path)
+                self.close_journal()
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+            except:
+                logger.exception('failed to save checkpoint.json')
 
-    # Get contents of Google Drive clubs folder
-    folder_list = gdrive.list_contents(config.club_folders_id)
-    
-    # Get Google Drive folder IDs for each club folder
-    for club in wordpress.club_list:
-        if 'unknown' not in club.lower():
-            logger.info(f'club name: {club}')
-            club_folder_id = ''
-            for club_folder in folder_list:
-                if club_folder['title'] == club:
-                    club_folder_id = club_folder['id']
-                    logger.info(f'club folder id: {club_folder_id}')
-                    break
-            
-            if not club_folder_id:
-                logger.info('no club folder found. Creating...')
-
-                # Create the club folder
-                club_folder_id = gdrive.create_folder(club, config.club_folders_id)
-                logger.info(f'club folder id: {club_folder_id}')
-
-            # Get a list of files within the club's Google Drive folder
-            file_list = gdrive.list_contents(club_folder_id)
-
-            # Get existing file ID if present so that we can overwrite the old spreadsheet with the new one
-            filename = f'{club}.xlsx'
-            gfile_id = ''
-            for gfile in file_list:
-                if gfile['title'] == filename:
-                    gfile_id = gfile['id']
-                    logger.info(f'club spreadsheet id: {gfile_id}')
-                    break
-
-            # Create and upload members_list.xlsx
-            filepath = f'{config.path(filename)}'
-            file = gdrive.create_file(filepath, filename, club_folder_id, gfile_id)
-            file = gdrive.upload(file, f'{filename} successfully uploaded')
-            
-            # Clean up local copy of the club members spreadsheet
-            os.remove(filepath)
+    def record(self, event):
+        # Append one event to the journal. Called with the lock held
+        try:
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'a')
+            self.journal.write(json.dumps(event) + '\n')
+            self.journal.flush()
+        except:
+            logger.exception('failed to write checkpoint.jsonl')
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def done(self, stage):
+        return stage in self.state['stages']
+
+    def complete(self, stage):
+        with self.lock:
+            if stage not in self.state['stages']:
+                self.state['stages'].append(stage)
+        self.save()
+
+    def save_exports(self, wordpress):
+        os.makedirs(self.directory, exist_ok=True)
+        save_snapshot(wordpress.membership, f'{self.directory}/membership.parquet')
+        save_snapshot(wordpress.orders, f'{self.directory}/orders.parquet')
+        self.complete('exports')
+
+    def load_exports(self):
+        # The exports saved by the failed run, or None if they are missing
+        if not self.done('exports'):
+            return None
+        membership = load_snapshot(f'{self.directory}/membership.parquet')
+        orders = load_snapshot(f'{self.directory}/orders.parquet')
+        if membership is None or orders is None:
+            return None
+        logger.info('using the exports downloaded by the previous run')
+        return Wordpress.from_frames(membership, orders)
+
+    def built(self, filename, digest):
+        with self.lock:
+            self.state['spreadsheets'][filename] = digest
+            self.record({'built': filename, 'digest': digest})
+
+    def reusable(self, filename, digest):
+        # A workbook can be reused if it was built from the same data and is already uploaded or still on disk
+        if self.state['spreadsheets'].get(filename) != digest:
+            return False
+        if self.is_uploaded(filename):
+            return True
+        return not self.config.in_memory and os.path.exists(self.config.path(filename))
+
+    def uploaded(self, filename):
+        with self.lock:
+            self.state['uploaded'].add(filename)
+            self.record({'uploaded': filename})
+
+    def is_uploaded(self, filename):
+        return filename in self.state['uploaded']
+
+    def clear(self):
+        # Forget the journal once a run completes, or when a new run starts. Workbooks kept on disk for --resume after
+        # a failed upload are removed with it
+        with self.lock:
+            self.close_journal()
+        workbooks = [self.config.path(filename) for filename in self.state['spreadsheets']]
+        for path in (self.path, self.journal_path, f'{self.directory}/membership.parquet', f'{self.directory}/orders.parquet', *workbooks):
+            if os.path.exists(path):
+                os.remove(path)
+        self.state = {'stages': [], 'spreadsheets': {}, 'uploaded': set()}
+        if os.path.isdir(self.directory) and not os.listdir(self.directory):
+            os.rmdir(self.directory)
+
+class Service():
+    # Long running mode (--serve). Runs the pipeline every interval_minutes, or straight away when a POST /run
+    # arrives on the local trigger endpoint, keeping the Wordpress session and Google Drive client warm between runs
+    def __init__(self, config):
+        global service_mode
+        service_mode = True
+        self.config = config
+        self.trigger = threading.Event()
+        self.lock = threading.Lock()
+        self.session = None
+        self.session_started = 0
+        self.google_drive = None
+        self.status = {'state': 'starting', 'runs': 0, 'last_run': None, 'last_result': None, 'next_run': None}
+
+    def serve(self):
+        server = ThreadingHTTPServer((self.config.trigger_host, self.config.trigger_port), self.handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f'service listening on http://{self.config.trigger_host}:{server.server_port}, running every {self.config.interval_minutes} minutes')
+
+        interval = self.config.interval_minutes * 60
+        next_run = time.time() if self.config.run_on_start else time.time() + interval
+        while True:
+            # A failed login or token refresh is tried again on the next wake up, and a run without warm sessions
+            # logs in by itself
+            try:
+                self.keep_warm()
+            except Exception:
+                logger.exception('failed to keep the Wordpress and Google Drive sessions warm')
+                self.drop_sessions()
+            self.update_status(state='idle', next_run=next_run)
+
+            # Wake up at least once a minute to keep the sessions warm while waiting
+            if self.trigger.wait(timeout=max(0, min(next_run - time.time(), 60))) or time.time() >= next_run:
+                reason = 'triggered' if self.trigger.is_set() else 'scheduled'
+                self.trigger.clear()
+                self.run_once(reason)
+                next_run = time.time() + interval
+
+    def keep_warm(self):
+        # Log in to Wordpress again before the session gets old, and renew the Google Drive token before it expires
+        if self.session is None or time.time() - self.session_started > self.config.session_hours * 3600:
+            if self.session is not None:
+                self.session.close()
+            self.session = Wordpress.connect(self.config)
+            self.session_started = time.time()
+
+        if self.google_drive is None:
+            self.google_drive = GoogleDrive(self.config)
+        self.google_drive.refresh(self.config, self.config.token_refresh_minutes * 60)
+
+    def run_once(self, reason):
+        global metrics
+        metrics = Metrics()
+        logger.info(f'starting {reason} run')
+        self.update_status(state='running', last_run=time.time())
+        try:
+            failed = run(self.config, session=self.session, google_drive=self.google_drive)
+            result = f'{len(failed)} spreadsheets failed' if failed else 'succeeded'
+        except Exception as error:
+            logger.exception(f'{reason} run failed')
+            result = f'failed: {error}'
+
+            # Log in from scratch for the next run in case a stale session caused the failure
+            self.drop_sessions()
+        finally:
+            metrics.write(self.config)
+
+        with self.lock:
+            self.status['runs'] += 1
+        self.update_status(last_result=result)
+        logger.info(f'{reason} run finished: {result}')
+
+    def drop_sessions(self):
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+        self.google_drive = None
+
+    def update_status(self, **kwargs):
+        with self.lock:
+            self.status.update(kwargs)
+
+    def handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != '/run':
+                    self.send_error(404)
+                    return
+
+                # Runs are never overlapped: a trigger during a run starts another run once it finishes
+                service.trigger.set()
+                self.respond(202, {'queued': True})
+
+            def do_GET(self):
+                if self.path != '/status':
+                    self.send_error(404)
+                    return
+
+                with service.lock:
+                    self.respond(200, dict(service.status))
+
+            def respond(self, status, data):
+                body = json.dumps(data).encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f'trigger endpoint: {format % args}')
+
+        return Handler
 
 def main():
+    parser = argparse.ArgumentParser(description='Export Paid Memberships Pro data into per club spreadsheets on Google Drive')
+    parser.add_argument('--resume', action='store_true', help='continue the last failed run, reusing its downloaded exports, built spreadsheets and finished uploads')
+    parser.add_argument('--serve', action='store_true', help='keep running, starting a run on the configured interval or on POST /run to the local trigger endpoint')
+    args = parser.parse_args()
+
     working_dir = f'{os.path.dirname(__file__)}'
     global logger 
     logger = create_logger(working_dir)
+    global metrics
+    metrics = Metrics()
     config = Config(f'{working_dir}/config.yaml')
-    wordpress = Wordpress(config)
-    create_spreadsheets(config, wordpress)
-    google_drive = GoogleDrive(config)
-    data_upload(google_drive, wordpress, config)
+    if args.serve:
+        Service(config).serve()
+        return
+
+    try:
+        run(config, args.resume)
+    finally:
+        metrics.write(config)
+
+def run(config, resume=False, session=None, google_drive=None):
+    # The service mode passes in its warm Wordpress session and Google Drive client. Returns the spreadsheets that
+    # failed to build or upload
+    checkpoint = Checkpoint(config, resume)
+
+    wordpress = checkpoint.load_exports() if resume else None
+    if wordpress is None:
+        wordpress = Wordpress(config, session)
+        checkpoint.save_exports(wordpress)
+        if config.snapshots_keep:
+            with metrics.stage('snapshots'):
+                SnapshotStore(config).save(wordpress)
+
+    workbooks = WorkbookStore(config)
+    try:
+        with metrics.stage('create_spreadsheets'):
+            spreadsheets, failed = create_spreadsheets(config, wordpress, workbooks, checkpoint)
+        if not spreadsheets and not failed:
+            logger.info('no spreadsheets changed since the last upload')
+            checkpoint.clear()
+            return []
+        if spreadsheets:
+            if google_drive is None:
+                with metrics.stage('google_drive_auth'):
+                    google_drive = GoogleDrive(config)
+            with metrics.stage('data_upload'):
+                succeeded, upload_failed = data_upload(google_drive, wordpress, config, spreadsheets, workbooks, checkpoint)
+            failed += upload_failed
+    finally:
+        workbooks.close()
+        checkpoint.close_journal()
+
+    # Keep the journal when spreadsheets failed so that --resume only retries those
+    if failed:
+        logger.info(f'run with --resume to retry the {len(failed)} failed spreadsheets')
+    else:
+        checkpoint.clear()
+
+    return failed
 
 if __name__ == "__main__":
     main()